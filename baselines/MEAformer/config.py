@@ -28,6 +28,8 @@ class cfg():
         parser.add_argument("--exp_id", default="001", type=str, help="Experiment ID")
         parser.add_argument("--random_seed", default=42, type=int)
         parser.add_argument("--data_path", default="mmkg", type=str, help="Experiment path")
+        parser.add_argument("--data_cache", type=int, default=0, choices=[0, 1], help="build / reuse preprocessed dataset artifacts in cache_dir (writes to disk, off by default)")
+        parser.add_argument("--cache_dir", default="", type=str, help="preprocessed artifact folder (default: {data_path}/cache)")
 
         # --------- EA -----------
         parser.add_argument("--data_choice", default="DBP15K", type=str, choices=["DBP15K", "DWY", "FBYG15K", "FBDB15K"], help="Experiment path")
@@ -46,6 +48,10 @@ class cfg():
         parser.add_argument('--weight_decay', type=float, default=0.0001)
         parser.add_argument("--adam_epsilon", default=1e-8, type=float)
         parser.add_argument('--eval_epoch', default=100, type=int, help='evaluate each n epoch')
+        parser.add_argument('--emb_cache', default=1, type=int, choices=[0, 1], help='reuse the entity embeddings between eval / test / iterative learning while the weights are unchanged')
+        parser.add_argument('--emb_cache_fp16', default=0, type=int, choices=[0, 1], help='store the cached entity embeddings in half precision')
+        parser.add_argument('--emb_cache_offload', default=0, type=int, choices=[0, 1], help='store the cached entity embeddings on the CPU')
+        parser.add_argument('--log_steps', default=0, type=int, help='read the training statistics back from the device and log them every n steps (0: only at the end of each epoch)')
         parser.add_argument("--enable_sota", action="store_true", default=False)
 
         parser.add_argument('--margin', default=1, type=float, help='The fixed margin in loss function. ')
@@ -62,14 +68,20 @@ class cfg():
         parser.add_argument("--distance", type=int, default=2, help="L1 distance or L2 distance. ('1', '2')", choices=[1, 2])
         parser.add_argument("--csls", action="store_true", default=False, help="use CSLS for inference")
         parser.add_argument("--csls_k", type=int, default=10, help="top k for csls")
+        parser.add_argument("--il_csls", type=int, default=0, choices=[0, 1], help="score the iterative learning proposals with CSLS (csls_k)")
+        parser.add_argument("--pred_topk", type=int, default=3, help="number of candidates written per query in the final prediction file (>= 1, capped at the number of test candidates)")
+        parser.add_argument("--pred_format", type=str, default="csv", choices=["csv", "npz", "both"], help="format of the final prediction file")
+        parser.add_argument("--eval_block_size", type=int, default=4096, help="number of query rows ranked at once during evaluation")
         parser.add_argument("--il", action="store_true", default=False, help="Iterative learning?")
         parser.add_argument("--semi_learn_step", type=int, default=10, help="If IL, what's the update step?")
         parser.add_argument("--il_start", type=int, default=500, help="If Il, when to start?")
+        parser.add_argument("--il_async", type=int, default=0, choices=[0, 1], help="run the iterative learning proposal in the background, merged at the next IL step")
         parser.add_argument("--unsup", action="store_true", default=False)
         parser.add_argument("--unsup_k", type=int, default=1000, help="|visual seed|")
 
         # --------- MCLEA -----------
         parser.add_argument("--unsup_mode", type=str, default="img", help="unsup mode", choices=["img", "name", "char"])
+        parser.add_argument("--unsup_match", type=str, default="greedy", choices=["greedy", "mutual"], help="seed selection: greedy one-to-one over the top pairs, or mutual nearest neighbours")
         parser.add_argument("--tau", type=float, default=0.1, help="the temperature factor of contrastive loss")
         parser.add_argument("--alpha", type=float, default=0.2, help="the margin of InfoMaxNCE loss")
         parser.add_argument("--with_weight", type=int, default=1, help="Whether to weight the fusion of different ")
@@ -87,6 +99,8 @@ class cfg():
         parser.add_argument("--w_gcn", action="store_false", default=True, help="with gcn features")
         parser.add_argument("--w_rel", action="store_false", default=True, help="with rel features")
         parser.add_argument("--w_attr", action="store_false", default=True, help="with attr features")
+        parser.add_argument("--rel_topk", type=int, default=1000, help="number of most frequent relations in the relation features")
+        parser.add_argument("--attr_topk", type=int, default=1000, help="number of most frequent attributes in the attribute features")
         parser.add_argument("--w_name", action="store_false", default=True, help="with name features")
         parser.add_argument("--w_char", action="store_false", default=True, help="with char features")
         parser.add_argument("--w_img", action="store_false", default=True, help="with img features")
@@ -107,7 +121,11 @@ class cfg():
         parser.add_argument("--position_embedding_type", default="absolute", type=str)
         parser.add_argument("--use_intermediate", type=int, default=1, help="whether to use_intermediate")
         parser.add_argument("--replay", type=int, default=0, help="whether to use replay strategy")
+        parser.add_argument("--subgraph_train", type=int, default=0, choices=[0, 1], help="encode only the batch entities and their k-hop subgraph in each training step")
         parser.add_argument("--neg_cross_kg", type=int, default=0, help="whether to force the negative samples in the opposite KG")
+        parser.add_argument("--cl_block_size", type=int, default=0, help="compute the contrastive logits by blocks of n rows, recomputed in the backward, to train with large batches (0: dense logits)")
+        parser.add_argument("--queue_size", type=int, default=0, help="size of the memory queue of recent pair embeddings used as extra negatives of the contrastive losses (0: in-batch negatives only)")
+        parser.add_argument("--queue_max_age", type=int, default=0, help="ignore the queued embeddings enqueued more than n training steps ago (0: no limit)")
         parser.add_argument("--use_domain_align", type=int, default=0, choices=[0, 1], help="enable simple domain alignment loss on joint embeddings")
         parser.add_argument("--domain_align_weight", type=float, default=0.0, help="weight for domain alignment loss")
         parser.add_argument("--use_source_select", type=int, default=0, choices=[0, 1], help="enable source-selection loss across modalities")
@@ -131,6 +149,8 @@ class cfg():
         parser.add_argument('--rank', type=int, default=0, help='rank to dist')
         parser.add_argument('--dist', type=int, default=0, help='whether to dist')
         parser.add_argument('--device', default='cuda', help='device id (i.e. 0 or 0,1 or cpu)')
+        parser.add_argument("--num_threads", type=int, default=0, help="intra-op threads on CPU (0: torch default)")
+        parser.add_argument("--matmul_precision", type=str, default="highest", choices=["highest", "high", "medium"], help="torch.set_float32_matmul_precision")
         parser.add_argument('--world-size', default=3, type=int,
                             help='number of distributed processes')
         parser.add_argument('--dist-url', default='env://', help='url used to set up distributed training')
@@ -142,6 +162,7 @@ class cfg():
         # add some constraint for parameters
         # e.g. cannot save and test at the same time
         assert not (self.cfg.save_model and self.cfg.only_test)
+        assert self.cfg.pred_topk >= 1, "--pred_topk must be at least 1"
 
         # update some dynamic variable
         self.cfg.data_root = self.data_root
@@ -170,6 +191,8 @@ class cfg():
         self.cfg.exp_id = f"{self.cfg.model_name}_{self.cfg.data_choice}_{data_split_name}{self.cfg.exp_id}"
         self.cfg.data_path = osp.join(self.data_root, self.cfg.data_path)
         self.cfg.dump_path = osp.join(self.cfg.data_path, self.cfg.dump_path)
+        if not self.cfg.cache_dir:
+            self.cfg.cache_dir = osp.join(self.cfg.data_path, "cache")
         if self.cfg.only_test == 1:
             self.save_model = 0
             self.dist = 0
@@ -3,8 +3,7 @@ import os.path as osp
 import torch
 import numpy as np
 from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import DataLoader, RandomSampler
-from torch.cuda.amp import GradScaler, autocast
+from torch.amp import GradScaler
 from datetime import datetime
 from easydict import EasyDict as edict
 from tqdm import tqdm
@@ -16,8 +15,8 @@ from collections import defaultdict
 
 from config import cfg
 from torchlight import initialize_exp, set_seed, get_dump_path
-from src.data import load_data, Collator_base, EADataset
-from src.utils import set_optim, Loss_log, pairwise_distances, csls_sim
+from src.data import load_data, EADataset, PairBatchIterator
+from src.utils import set_optim, setup_device, Loss_log, tiled_gold_ranks, rank_metrics, save_predictions
 from model import MEAformer
 
 from src.distributed_utils import init_distributed_mode, dist_pdb, is_main_process, reduce_value, cleanup
@@ -27,6 +26,7 @@ import torch.nn.functional as F
 import scipy
 import gc
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Runner:
@@ -38,17 +38,19 @@ class Runner:
         self.args = args
         self.writer = writer
         self.logger = logger
-        self.scaler = GradScaler()
+        # loss scaling is only needed (and supported) on CUDA
+        self.scaler = GradScaler("cuda", enabled=(self.args.device.type == "cuda"))
         self.model_list = []
+        # bumped whenever the weights change (optimizer step, state dict load): key of the embedding snapshot
+        self.weights_version = 0
+        self.emb_snapshot = None
         set_seed(args.random_seed)
         self.data_init()
         self.model_choise()
         set_seed(args.random_seed)
 
-        if self.args.only_test:
-            self.dataloader_init(test_set=self.test_set)
-        else:
-            self.dataloader_init(train_set=self.train_set, eval_set=self.eval_set, test_set=self.test_set)
+        if not self.args.only_test:
+            self.dataloader_init(train_set=self.train_set)
             if self.args.dist:
                 self.model_sync()
             else:
@@ -107,76 +109,40 @@ class Runner:
     def data_init(self):
         self.KGs, self.non_train, self.train_set, self.eval_set, self.test_set, self.test_ill_ = load_data(self.logger, self.args)
         self.train_ill = self.train_set.data
-        self.eval_left = torch.LongTensor(self.eval_set[:, 0].squeeze()).cuda()
-        self.eval_right = torch.LongTensor(self.eval_set[:, 1].squeeze()).cuda()
+        self.eval_left = torch.LongTensor(self.eval_set[:, 0].squeeze()).to(self.args.device)
+        self.eval_right = torch.LongTensor(self.eval_set[:, 1].squeeze()).to(self.args.device)
         if self.test_set is not None:
-            self.test_left = torch.LongTensor(self.test_ill[:, 0].squeeze()).cuda()
-            self.test_right = torch.LongTensor(self.test_ill[:, 1].squeeze()).cuda()
-
-        self.eval_sampler = None
-        if self.args.dist and not self.args.only_test:
-            self.train_sampler = torch.utils.data.distributed.DistributedSampler(self.train_set)
-            self.eval_sampler = torch.utils.data.distributed.DistributedSampler(self.eval_set)
-            if self.test_set is not None:
-                self.test_sampler = torch.utils.data.distributed.DistributedSampler(self.test_set)
-
-    def dataloader_init(self, train_set=None, eval_set=None, test_set=None):
-        bs = self.args.batch_size
-        collator = Collator_base(self.args)
-        if self.args.dist and not self.args.only_test:
-            self.args.workers = min([os.cpu_count(), self.args.batch_size, self.args.workers])
-            if train_set is not None:
-                self.train_dataloader = self._dataloader_dist(train_set, self.train_sampler, bs, collator)
-            if test_set is not None:
-                self.test_dataloader = self._dataloader_dist(test_set, self.test_sampler, bs, collator)
-            if eval_set is not None:
-                self.eval_dataloader = self._dataloader_dist(eval_set, self.eval_sampler, bs, collator)
-        else:
-            self.args.workers = min([os.cpu_count(), self.args.batch_size, self.args.workers])
-            if train_set is not None:
-                self.train_dataloader = self._dataloader(train_set, bs, collator)
-            if test_set is not None:
-                self.test_dataloader = self._dataloader(test_set, bs, collator)
-            if eval_set is not None:
-                self.eval_dataloader = self._dataloader(eval_set, bs, collator)
-
-    def _dataloader_dist(self, train_set, train_sampler, batch_size, collator):
-        train_dataloader = DataLoader(
-            train_set,
-            sampler=train_sampler,
-            pin_memory=True,
-            num_workers=self.args.workers,
-            persistent_workers=True,  # True
-            drop_last=True,
-            batch_size=batch_size,
-            collate_fn=collator
-        )
-        return train_dataloader
-
-    def _dataloader(self, train_set, batch_size, collator):
-        train_dataloader = DataLoader(
-            train_set,
-            num_workers=self.args.workers,
-            persistent_workers=True,  # True
-            shuffle=(self.args.only_test == 0),
-            # drop_last=(self.args.only_test == 0),
-            drop_last=False,
-            batch_size=batch_size,
-            collate_fn=collator
-        )
-        return train_dataloader
+            self.test_left = torch.LongTensor(self.test_ill[:, 0].squeeze()).to(self.args.device)
+            self.test_right = torch.LongTensor(self.test_ill[:, 1].squeeze()).to(self.args.device)
+
+    def dataloader_init(self, train_set=None):
+        # training pairs stay on the device, shuffled/sharded by PairBatchIterator
+        if train_set is not None:
+            dist_train = self.args.dist and not self.args.only_test
+            self.train_dataloader = PairBatchIterator(train_set.data, self.args.batch_size, self.args.device,
+                                                      shuffle=(self.args.only_test == 0), seed=self.args.random_seed,
+                                                      num_replicas=self.args.world_size if dist_train else 1,
+                                                      rank=self.args.rank if dist_train else 0, drop_last=dist_train)
 
     def run(self):
         self.loss_log = Loss_log()
         self.curr_loss = 0.
         self.lr = self.args.lr
         self.curr_loss_dic = defaultdict(float)
+        # per-step statistics summed on the device, read back by flush_statistic
+        self.pending_loss = None
+        self.pending_loss_dic = {}
+        self.pending_skipped = None
         self.weight = [1, 1, 1, 1, 1, 1]
         self.loss_weight = [1, 1]
         self.loss_item = 99999.
         self.step = 1
         self.epoch = 0
-        self.new_links = []
+        self.new_links = np.zeros((0, 2), dtype=np.int64)
+        # --il_async: background proposal (Iter_new_links) and the epoch it was started at
+        self.il_executor = None
+        self.il_future = None
+        self.il_future_epoch = None
         self.best_model_wts = None
 
         self.best_mrr = 0
@@ -188,8 +154,7 @@ class Runner:
         with tqdm(total=self.args.epoch) as _tqdm:
             for i in range(self.args.epoch):
                 # _tqdm.set_description(f'Train | epoch {i} Loss {self.loss_log.get_loss():.5f} Acc {self.loss_log.get_acc()*100:.3f}%')
-                if self.args.dist and not self.args.only_test:
-                    self.train_sampler.set_epoch(i)
+                self.train_dataloader.set_epoch(i)
                 # -------------------------------
                 self.epoch = i
                 if self.args.il and (self.epoch == self.args.il_start and self.stage == 0) or (self.early_stop_count <= 0 and self.epoch <= self.args.il_start):
@@ -207,18 +172,28 @@ class Runner:
                     if self.best_model_wts is not None:
                         self.logger.info("load from the best model before IL... ")
                         self.model.load_state_dict(self.best_model_wts)
+                        self.weights_updated()
+                        self.model.reset_queues()
                     name = self._save_name_define()
                     self.test(save_name=f"{name}_test_ep{self.args.epoch}_no_iter")
                     if self.rank == 0:
                         if not self.args.only_test and self.args.save_model:
                             self._save_model(self.model, input_name=f"{name}_non_iter")
 
-                if self.stage == 1 and (self.epoch + 1) % self.args.semi_learn_step == 0 and self.args.il:
-                    self.il_for_ea()
+                il_step = self.stage == 1 and (self.epoch + 1) % self.args.semi_learn_step == 0 and self.args.il
+                if il_step:
+                    if self.args.il_async:
+                        # proposal started at the previous IL step
+                        self.il_merge()
+                    else:
+                        self.il_for_ea()
 
                 if self.stage == 1 and (self.epoch + 1) % (self.args.semi_learn_step * 10) == 0 and len(self.new_links) != 0 and self.args.il:
                     self.il_for_data_ref()
 
+                if il_step and self.args.il_async:
+                    self.il_for_ea_async()
+
                 self.train(_tqdm)
                 self.loss_log.update(self.curr_loss)
                 self.loss_item = self.loss_log.get_loss()
@@ -231,10 +206,17 @@ class Runner:
                     logger.info(f"Early stop in epoch {self.epoch}")
                     break
 
+        if self.il_executor is not None:
+            # a proposal still running is of no use after the last epoch
+            self.il_executor.shutdown(wait=True)
+            self.il_executor = self.il_future = None
+
         name = self._save_name_define()
         if self.best_model_wts is not None:
             self.logger.info("load from the best model before final testing ... ")
             self.model.load_state_dict(self.best_model_wts)
+            self.weights_updated()
+            self.model.reset_queues()
         self.test(save_name=f"{name}_test_ep{self.args.epoch}")
 
         if self.rank == 0:
@@ -242,23 +224,86 @@ class Runner:
             if not self.args.only_test and self.args.save_model:
                 self._save_model(self.model, input_name=name)
 
+    def weights_updated(self):
+        self.weights_version += 1
+        self.emb_snapshot = None
+
+    def embedding_snapshot(self):
+        """
+        normalized final_emb and weight_norm of the current weights: joint_emb_generat runs once per
+        (weights_version, train / eval mode) and its result is shared by eval, test and iterative learning.
+        --emb_cache_fp16 / --emb_cache_offload store the snapshot in half precision / on the CPU.
+        """
+        key = (self.weights_version, self.model.training)
+        if self.emb_snapshot is not None and self.emb_snapshot[0] == key:
+            _, final_emb, weight_norm = self.emb_snapshot
+        else:
+            with torch.no_grad():
+                if self.args.model_name in ["MEAformer"]:
+                    final_emb, weight_norm = self.model.joint_emb_generat()
+                else:
+                    final_emb = self.model.joint_emb_generat()
+                    weight_norm = None
+                final_emb = F.normalize(final_emb)
+            if self.args.emb_cache_fp16:
+                final_emb = final_emb.half()
+            if self.args.emb_cache_offload:
+                final_emb = final_emb.cpu()
+                weight_norm = weight_norm.cpu() if weight_norm is not None else None
+            if self.args.emb_cache:
+                self.emb_snapshot = (key, final_emb, weight_norm)
+        final_emb = final_emb.to(self.args.device, dtype=torch.float32)
+        weight_norm = weight_norm.to(self.args.device) if weight_norm is not None else None
+        return final_emb, weight_norm
+
     def il_for_ea(self):
         with torch.no_grad():
-            if self.args.model_name in ["MEAformer"]:
-                final_emb, weight_norm = self.model.joint_emb_generat()
-            else:
-                final_emb = self.model.joint_emb_generat()
-            final_emb = F.normalize(final_emb)
+            final_emb, weight_norm = self.embedding_snapshot()
             self.new_links = self.model.Iter_new_links(self.epoch, self.non_train["left"], final_emb, self.non_train["right"], new_links=self.new_links)
             if (self.epoch + 1) % (self.args.semi_learn_step * 5) == 0:
                 self.logger.info(f"[epoch {self.epoch}] #links in candidate set: {len(self.new_links)}")
 
+    def il_for_ea_async(self):
+        """
+        il_for_ea without blocking the training: the embeddings are snapshotted now and the proposal
+        runs on a worker thread (and a side CUDA stream); il_merge collects it at the next IL step.
+        """
+        final_emb, weight_norm = self.embedding_snapshot()
+        stream = None
+        if final_emb.is_cuda:
+            stream = torch.cuda.Stream(device=final_emb.device)
+            stream.wait_stream(torch.cuda.current_stream(final_emb.device))
+        if self.il_executor is None:
+            self.il_executor = ThreadPoolExecutor(max_workers=1)
+        epoch, left, right, new_links = self.epoch, self.non_train["left"].copy(), self.non_train["right"].copy(), self.new_links
+
+        def propose():
+            if stream is None:
+                return self.model.Iter_new_links(epoch, left, final_emb, right, new_links=new_links)
+            with torch.cuda.device(final_emb.device), torch.cuda.stream(stream):
+                return self.model.Iter_new_links(epoch, left, final_emb, right, new_links=new_links)
+        self.il_future = self.il_executor.submit(propose)
+        self.il_future_epoch = epoch
+
+    def il_merge(self):
+        if self.il_future is None:
+            return
+        new_links = self.il_future.result()
+        self.il_future = None
+        # drop the links of entities moved to the train set by a refresh since the proposal started
+        keep = np.isin(new_links[:, 0], self.non_train["left"]) & np.isin(new_links[:, 1], self.non_train["right"])
+        self.new_links = new_links[keep]
+        if (self.il_future_epoch + 1) % (self.args.semi_learn_step * 5) == 0:
+            self.logger.info(f"[epoch {self.il_future_epoch}] #links in candidate set: {len(self.new_links)}")
+
     def il_for_data_ref(self):
+        num_train = len(self.train_ill)
         self.non_train["left"], self.non_train["right"], self.train_ill, self.new_links = self.model.data_refresh(
             self.logger, self.train_ill, self.test_ill_, self.non_train["left"], self.non_train["right"], new_links=self.new_links)
         set_seed(self.args.random_seed)
         self.train_set = EADataset(self.train_ill)
-        self.dataloader_init(train_set=self.train_set)
+        # only the new links are copied to the device
+        self.train_dataloader.append(self.train_ill[num_train:])
         # one time train
 
     def _save_name_define(self):
@@ -272,7 +317,6 @@ class Runner:
 
     def train(self, _tqdm):
         self.model.train()
-        curr_loss = 0.
         self.loss_log.acc_init()
         accumulation_steps = self.args.accumulation_steps
         # torch.cuda.empty_cache()
@@ -284,19 +328,25 @@ class Runner:
                 loss = reduce_value(loss, average=True)
             self.step += 1
             if not self.args.dist or is_main_process():
-                curr_loss += loss.item()
                 self.output_statistic(loss, output)
+            if self.args.log_steps > 0 and self.step % self.args.log_steps == 0:
+                if not self.args.dist or is_main_process():
+                    self.flush_statistic(log=True)
+                self.sync_device_state()
 
             if self.step % accumulation_steps == 0:
                 self.scaler.unscale_(self.optimizer)
                 for model in self.model_list:
                     torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.clip)
-                scale = self.scaler.get_scale()
+                scale = self.scaler._scale.clone() if self.scaler.is_enabled() else None
                 self.scaler.step(self.optimizer)
+                self.weights_updated()
                 self.scaler.update()
-                skip_lr_sched = (scale > self.scaler.get_scale())
-                if not skip_lr_sched:
-                    self.scheduler.step()
+                if scale is not None:
+                    # update() lowers the scale exactly when the step was skipped (inf / nan gradients)
+                    skipped = (self.scaler._scale < scale).to(torch.int64)
+                    self.pending_skipped = skipped if self.pending_skipped is None else self.pending_skipped + skipped
+                self.scheduler.step()
 
                 if not self.args.dist or is_main_process():
                     self.lr = self.scheduler.get_last_lr()[-1]
@@ -307,19 +357,53 @@ class Runner:
             if self.args.dist:
                 torch.cuda.synchronize(self.args.device)
 
-        return curr_loss
+        self.flush_statistic()
+        self.sync_device_state()
+        return self.curr_loss
+
+    def sync_device_state(self):
+        """
+        Read back what train() keeps on the device between log steps: the optimizer steps skipped by
+        the GradScaler, which the scheduler (a LambdaLR) is stepped back over, and the start of replay.
+        """
+        if self.pending_skipped is not None:
+            skipped = int(self.pending_skipped)
+            self.pending_skipped = None
+            if skipped > 0:
+                self.scheduler.last_epoch -= skipped + 1
+                self.scheduler.step()
+                self.lr = self.scheduler.get_last_lr()[-1]
+        self.model.update_replay_ready()
 
     def output_statistic(self, loss, output):
-        self.curr_loss += loss.item()
+        loss = loss.detach()
+        self.pending_loss = loss if self.pending_loss is None else self.pending_loss + loss
         if output is None:
             return
-        for key in output['loss_dic'].keys():
-            self.curr_loss_dic[key] += output['loss_dic'][key]
+        for key, value in output['loss_dic'].items():
+            self.pending_loss_dic[key] = self.pending_loss_dic.get(key, 0.) + value
         if 'weight' in output and output['weight'] is not None:
             self.weight = output['weight']
         if 'loss_weight' in output and output['loss_weight'] is not None:
             self.loss_weight = output['loss_weight']
 
+    def flush_statistic(self, log=False):
+        # a single device -> host copy for all the statistics summed since the last flush
+        if self.pending_loss is None:
+            return
+        keys = list(self.pending_loss_dic.keys())
+        values = torch.stack([self.pending_loss] + [torch.as_tensor(self.pending_loss_dic[key], dtype=self.pending_loss.dtype,
+                                                                    device=self.pending_loss.device) for key in keys]).tolist()
+        self.curr_loss += values[0]
+        for key, value in zip(keys, values[1:]):
+            self.curr_loss_dic[key] += value
+        if log:
+            vis_dict = {"train_loss": values[0]}
+            vis_dict.update(zip(keys, values[1:]))
+            self.writer.add_scalars("loss_step", vis_dict, self.step)
+        self.pending_loss = None
+        self.pending_loss_dic = {}
+
     def update_loss_log(self):
         vis_dict = {"train_loss": self.curr_loss}
         vis_dict.update(self.curr_loss_dic)
@@ -365,55 +449,25 @@ class Runner:
         self._test(test_left, test_right, last_epoch=last_epoch, save_name=save_name)
 
     def _test(self, test_left, test_right, last_epoch=False, save_name="", loss=None):
-        with torch.no_grad():
-            w_normalized = None
-            if self.args.model_name in ["MEAformer"]:
-                final_emb, weight_norm = self.model.joint_emb_generat()
-            else:
-                final_emb = self.model.joint_emb_generat()
-                weight_norm = None
-            final_emb = F.normalize(final_emb)
+        w_normalized = None
+        final_emb, weight_norm = self.embedding_snapshot()
 
         # pdb.set_trace()
         top_k = [1, 10, 50]
-        acc_l2r = np.zeros((len(top_k)), dtype=np.float32)
-        acc_r2l = np.zeros((len(top_k)), dtype=np.float32)
-        test_total, test_loss, mean_l2r, mean_r2l, mrr_l2r, mrr_r2l = 0, 0., 0., 0., 0., 0.
-        if self.args.distance == 2:
-            distance = pairwise_distances(final_emb[test_left], final_emb[test_right])
-        elif self.args.distance == 1:
-            distance = torch.FloatTensor(scipy.spatial.distance.cdist(
-                final_emb[test_left].cpu().data.numpy(),
-                final_emb[test_right].cpu().data.numpy(), metric="cityblock"))
-        if self.args.csls is True:
-            distance = 1 - csls_sim(1 - distance, self.args.csls_k)
+        csls_k = self.args.csls_k if self.args.csls is True else 0
+        pred_k = min(self.args.pred_topk, len(test_right)) if last_epoch else 0
+        rank_l2r, rank_r2l, preds = tiled_gold_ranks(final_emb[test_left], final_emb[test_right], distance=self.args.distance,
+                                                     csls_k=csls_k, block_size=self.args.eval_block_size, pred_k=pred_k)
+        acc_l2r, mean_l2r, mrr_l2r = rank_metrics(rank_l2r, top_k)
+        acc_r2l, mean_r2l, mrr_r2l = rank_metrics(rank_r2l, top_k)
 
         if last_epoch:
-            to_write = []
-            test_left_np = test_left.cpu().numpy()
-            test_right_np = test_right.cpu().numpy()
-            to_write.append(["idx", "rank", "query_id", "gt_id", "ret1", "ret2", "ret3", "v1", "v2", "v3"])
-        for idx in range(test_left.shape[0]):
-            values, indices = torch.sort(distance[idx, :], descending=False)
-            rank = (indices == idx).nonzero(as_tuple=False).squeeze().item()
-            mean_l2r += (rank + 1)
-            mrr_l2r += 1.0 / (rank + 1)
-            for i in range(len(top_k)):
-                if rank < top_k[i]:
-                    acc_l2r[i] += 1
-            if last_epoch:
-                indices = indices.cpu().numpy()
-                to_write.append([idx, rank, test_left_np[idx], test_right_np[idx], test_right_np[indices[0]], test_right_np[indices[1]],
-                                 test_right_np[indices[2]], round(values[0].item(), 4), round(values[1].item(), 4), round(values[2].item(), 4)])
-        if last_epoch:
-            import csv
             if save_name == "":
                 save_name = self.args.model_name
             save_pred_path = osp.join(self.args.data_path, self.args.model_name, f"{save_name}_pred")
             os.makedirs(save_pred_path, exist_ok=True)
-            with open(osp.join(save_pred_path, f"{self.args.model_name}_{self.args.data_choice}_{self.args.data_split}_{self.args.data_rate}_ep{self.args.il_start}_pred.txt"), "w") as f:
-                wr = csv.writer(f, dialect='excel')
-                wr.writerows(to_write)
+            save_predictions(osp.join(save_pred_path, f"{self.args.model_name}_{self.args.data_choice}_{self.args.data_split}_{self.args.data_rate}_ep{self.args.il_start}_pred"),
+                             test_left, test_right, rank_l2r, preds[0], preds[1], pred_format=self.args.pred_format)
             if w_normalized is not None:
                 with open(osp.join(save_pred_path, f"{self.args.model_name}_{self.args.data_choice}_{self.args.data_split}_{self.args.data_rate}_ep{self.args.il_start}_wight.json"), "w") as fp:
                     json.dump(w_normalized.cpu().tolist(), fp)
@@ -422,21 +476,6 @@ class Runner:
                 with open(osp.join(save_pred_path, f"{self.args.model_name}_{self.args.data_choice}_{self.args.data_split}_{self.args.data_rate}_ep{self.args.il_start}_wight_dic.pkl"), "wb") as fp:
                     pickle.dump(wight_dic, fp)
 
-        for idx in range(test_right.shape[0]):
-            _, indices = torch.sort(distance[:, idx], descending=False)
-            rank = (indices == idx).nonzero(as_tuple=False).squeeze().item()
-            mean_r2l += (rank + 1)
-            mrr_r2l += 1.0 / (rank + 1)
-            for i in range(len(top_k)):
-                if rank < top_k[i]:
-                    acc_r2l[i] += 1
-        mean_l2r /= test_left.size(0)
-        mean_r2l /= test_right.size(0)
-        mrr_l2r /= test_left.size(0)
-        mrr_r2l /= test_right.size(0)
-        for i in range(len(top_k)):
-            acc_l2r[i] = round(acc_l2r[i] / test_left.size(0), 4)
-            acc_r2l[i] = round(acc_r2l[i] / test_right.size(0), 4)
         gc.collect()
         if not self.args.only_test:
             Loss_out = f", Loss = {self.loss_item:.4f}"
@@ -468,14 +507,14 @@ class Runner:
                 self.logger.info(f"{model_name}.pkl not exist!!")
             else:
                 self.logger.info("Random init...")
-            model.cuda()
+            model.to(self.args.device)
             return model
         if 'Dist' in self.args.model_name:
             model.load_state_dict({k.replace('module.', ''): v for k, v in torch.load(save_path, map_location=self.args.device).items()})
         else:
             model.load_state_dict(torch.load(save_path, map_location=self.args.device))
 
-        model.cuda()
+        model.to(self.args.device)
         if self.rank == 0:
             self.logger.info(f"loading model [{model_name}.pkl] done!")
 
@@ -524,11 +563,10 @@ if __name__ == '__main__':
         if not cfgs.no_tensorboard and not cfgs.only_test:
             writer = SummaryWriter(log_dir=os.path.join(logger_path, 'tensorboard', cfgs.time_stamp), comment=comment)
 
-    cfgs.device = torch.device(cfgs.device)
+    cfgs.device = setup_device(cfgs)
 
     # print("print c to continue...")
     # -----  Begin ----------
-    torch.cuda.set_device(cfgs.gpu)
     runner = Runner(cfgs, writer, logger, rank)
     if cfgs.only_test:
         runner.test(last_epoch=False)
@@ -9,9 +9,9 @@ import pdb
 import math
 from .Tool_model import AutomaticWeightedLoss
 from .MEAformer_tools import MultiModalEncoder
-from .MEAformer_loss import CustomMultiLossLayer, icl_loss
+from .MEAformer_loss import CustomMultiLossLayer, icl_loss, multi_view_icl_loss, EmbeddingQueue
 
-from src.utils import pairwise_distances
+from src.utils import pairwise_distances, k_hop_subgraph, sparse_mx_to_torch_sparse_tensor, pair_keys, mutual_nearest_neighbours
 import os.path as osp
 import json
 
@@ -21,19 +21,21 @@ class MEAformer(nn.Module):
         super().__init__()
         self.kgs = kgs
         self.args = args
-        self.img_features = F.normalize(torch.FloatTensor(kgs["images_list"])).cuda()
+        self.device = torch.device(args.device)
+        self.img_features = F.normalize(torch.FloatTensor(kgs["images_list"])).to(self.device)
         self.img_mask = None
         if "img_mask" in kgs and kgs["img_mask"] is not None:
-            self.img_mask = torch.FloatTensor(kgs["img_mask"]).cuda()
-        self.input_idx = kgs["input_idx"].cuda()
-        self.adj = kgs["adj"].cuda()
-        self.rel_features = torch.Tensor(kgs["rel_features"]).cuda()
-        self.att_features = torch.Tensor(kgs["att_features"]).cuda()
+            self.img_mask = torch.FloatTensor(kgs["img_mask"]).to(self.device)
+        self.input_idx = kgs["input_idx"].to(self.device)
+        self.adj = kgs["adj"].to(self.device)
+        # bag-of-features kept sparse (coalesced COO) on device
+        self.rel_features = sparse_mx_to_torch_sparse_tensor(kgs["rel_features"]).coalesce().to(self.device)
+        self.att_features = sparse_mx_to_torch_sparse_tensor(kgs["att_features"]).coalesce().to(self.device)
         self.name_features = None
         self.char_features = None
         if kgs["name_features"] is not None:
-            self.name_features = kgs["name_features"].cuda()
-            self.char_features = kgs["char_features"].cuda()
+            self.name_features = kgs["name_features"].to(self.device)
+            self.char_features = sparse_mx_to_torch_sparse_tensor(kgs["char_features"]).coalesce().to(self.device)
 
         img_dim = self._get_img_dim(kgs)
 
@@ -44,18 +46,29 @@ class MEAformer(nn.Module):
                                                     img_feature_dim=img_dim,
                                                     char_feature_dim=char_dim,
                                                     use_project_head=self.args.use_project_head,
-                                                    attr_input_dim=kgs["att_features"].shape[1])
+                                                    attr_input_dim=kgs["att_features"].shape[1],
+                                                    rel_input_dim=kgs["rel_features"].shape[1])
 
         self.multi_loss_layer = CustomMultiLossLayer(loss_num=6)  # 6
-        self.criterion_cl = icl_loss(tau=self.args.tau, ab_weight=self.args.ab_weight, n_view=2)
-        self.criterion_cl_joint = icl_loss(tau=self.args.tau, ab_weight=self.args.ab_weight, n_view=2, replay=self.args.replay, neg_cross_kg=self.args.neg_cross_kg)
-
-        tmp = -1 * torch.ones(self.input_idx.shape[0], dtype=torch.int64).cuda()
-        self.replay_matrix = torch.stack([self.input_idx, tmp], dim=1).cuda()
+        self.criterion_cl = multi_view_icl_loss(tau=self.args.tau, ab_weight=self.args.ab_weight, block_size=self.args.cl_block_size)
+        self.criterion_cl_joint = icl_loss(tau=self.args.tau, ab_weight=self.args.ab_weight, n_view=2, replay=self.args.replay,
+                                           neg_cross_kg=self.args.neg_cross_kg, block_size=self.args.cl_block_size)
+        # --queue_size: memory of recent pair embeddings (raw / hidden modalities, joint) as extra negatives
+        self.queue_in, self.queue_out, self.queue_joint = None, None, None
+        if self.args.queue_size > 0:
+            self.queue_in = EmbeddingQueue(self.args.queue_size, self.args.queue_max_age)
+            self.queue_out = EmbeddingQueue(self.args.queue_size, self.args.queue_max_age)
+            self.queue_joint = EmbeddingQueue(self.args.queue_size, self.args.queue_max_age)
+
+        tmp = -1 * torch.ones(self.input_idx.shape[0], dtype=torch.int64, device=self.device)
+        self.replay_matrix = torch.stack([self.input_idx, tmp], dim=1)
         self.replay_ready = 0
-        self.idx_one = torch.ones(self.args.batch_size, dtype=torch.int64).cuda()
-        self.idx_double = torch.cat([self.idx_one, self.idx_one]).cuda()
-        self.last_num = 1000000000000
+        self.idx_one = torch.ones(self.args.batch_size, dtype=torch.int64, device=self.device)
+        self.idx_double = torch.cat([self.idx_one, self.idx_one])
+        # replay starts once a step leaves the number of unfilled replay slots unchanged; the count and
+        # the flag stay on the device and update_replay_ready reads them when the runner flushes
+        self.last_num = torch.full((), -1, dtype=torch.int64, device=self.device)
+        self.replay_stalled = torch.zeros((), dtype=torch.bool, device=self.device)
         # self.idx_one = np.ones(self.args.batch_size, dtype=np.int64)
 
     def _to_cuda_batch(self, batch, device):
@@ -76,7 +89,7 @@ class MEAformer(nn.Module):
         right_emb = joint_emb[batch[:, 1]]
         return F.mse_loss(left_emb, right_emb)
 
-    def _missing_aware_img_align_loss(self, img_emb, batch):
+    def _missing_aware_img_align_loss(self, img_emb, batch, ent_ids=None):
         if not getattr(self.args, "use_missing_gate", 0):
             return None
         if img_emb is None or self.img_mask is None or batch is None:
@@ -84,10 +97,12 @@ class MEAformer(nn.Module):
         batch = self._to_cuda_batch(batch, img_emb.device)
         left = batch[:, 0]
         right = batch[:, 1]
-        valid = (self.img_mask[left] > 0.5) & (self.img_mask[right] > 0.5)
-        if torch.sum(valid) == 0:
-            return torch.tensor(0.0, device=img_emb.device)
-        return F.mse_loss(img_emb[left[valid]], img_emb[right[valid]])
+        # with subgraph training the rows of img_emb (and batch) follow ent_ids
+        img_mask = self.img_mask if ent_ids is None else self.img_mask[ent_ids]
+        valid = ((img_mask[left] > 0.5) & (img_mask[right] > 0.5)).to(img_emb.dtype)
+        # mse over the valid pairs, masked instead of indexed so that no count is read back (0 if none)
+        sq_err = (img_emb[left] - img_emb[right]).pow(2).sum(dim=1)
+        return torch.sum(sq_err * valid) / (torch.sum(valid).clamp(min=1) * img_emb.shape[1])
 
     def _source_select_loss(self, modal_losses):
         if not getattr(self.args, "use_source_select", 0):
@@ -99,67 +114,75 @@ class MEAformer(nn.Module):
         temp = max(float(getattr(self.args, "source_select_temp", 1.0)), 1e-6)
         weights = torch.softmax(-values.detach() / temp, dim=0)
         selected_loss = torch.sum(weights * values)
-        weight_dict = {f"src_w_{name}": weights[i].item() for i, (name, _) in enumerate(active)}
+        weight_dict = {f"src_w_{name}": weights[i] for i, (name, _) in enumerate(active)}
         return selected_loss, weight_dict
 
     def forward(self, batch):
-        gph_emb, img_emb, rel_emb, att_emb, name_emb, char_emb, joint_emb, hidden_states = self.joint_emb_generat(only_joint=False)
+        batch = self._to_cuda_batch(batch, self.input_idx.device)
+        neg_l_ipt, neg_r_ipt = None, None
+        if self.args.replay and self.replay_ready:
+            all_ent_batch = torch.cat([batch[:, 0], batch[:, 1]])
+            neg_l = self.replay_matrix[batch[:, 0], self.idx_one[:batch.shape[0]]]
+            neg_r = self.replay_matrix[batch[:, 1], self.idx_one[:batch.shape[0]]]
+            # distinct replayed negatives that are not entities of the batch
+            neg_l_ipt = torch.unique(neg_l)
+            neg_r_ipt = torch.unique(neg_r)
+            neg_l_ipt = neg_l_ipt[~torch.isin(neg_l_ipt, all_ent_batch)]
+            neg_r_ipt = neg_r_ipt[~torch.isin(neg_r_ipt, all_ent_batch)]
+
+        if self.args.subgraph_train:
+            # only the batch entities (and replay negatives) are encoded, on their k-hop subgraph
+            ent_ids, batch_emb, neg_l_emb, neg_r_emb = self._subgraph_batch(batch, neg_l_ipt, neg_r_ipt)
+            gph_emb, img_emb, rel_emb, att_emb, name_emb, char_emb, joint_emb, hidden_states = self.subgraph_emb_generat(ent_ids)
+        else:
+            ent_ids, batch_emb, neg_l_emb, neg_r_emb = None, batch, neg_l_ipt, neg_r_ipt
+            gph_emb, img_emb, rel_emb, att_emb, name_emb, char_emb, joint_emb, hidden_states = self.joint_emb_generat(only_joint=False)
         gph_emb_hid, rel_emb_hid, att_emb_hid, img_emb_hid, name_emb_hid, char_emb_hid, joint_emb_hid = self.generate_hidden_emb(hidden_states)
-        batch = self._to_cuda_batch(batch, joint_emb.device)
         if self.args.replay:
             all_ent_batch = torch.cat([batch[:, 0], batch[:, 1]])
             if not self.replay_ready:
-                loss_joi, l_neg, r_neg = self.criterion_cl_joint(joint_emb, batch)
+                loss_joi, l_neg, r_neg = self.criterion_cl_joint(joint_emb, batch_emb, queue=self.queue_joint, link_ids=batch)
             else:
-                neg_l = self.replay_matrix[batch[:, 0], self.idx_one[:batch.shape[0]]]
-                neg_r = self.replay_matrix[batch[:, 1], self.idx_one[:batch.shape[0]]]
-                neg_l_set = set(neg_l.tolist())
-                neg_r_set = set(neg_r.tolist())
-                all_ent_set = set(all_ent_batch.tolist())
-                neg_l_list = list(neg_l_set - all_ent_set)
-                neg_r_list = list(neg_r_set - all_ent_set)
-                neg_l_ipt = torch.tensor(neg_l_list, dtype=torch.int64).cuda()
-                neg_r_ipt = torch.tensor(neg_r_list, dtype=torch.int64).cuda()
-                loss_joi, l_neg, r_neg = self.criterion_cl_joint(joint_emb, batch, neg_l_ipt, neg_r_ipt)
+                loss_joi, l_neg, r_neg = self.criterion_cl_joint(joint_emb, batch_emb, neg_l_emb, neg_r_emb, queue=self.queue_joint, link_ids=batch)
+            if ent_ids is not None:
+                l_neg, r_neg = ent_ids[l_neg], ent_ids[r_neg]
 
             index = (
                 all_ent_batch,
                 self.idx_double[:batch.shape[0] * 2],
             )
-            new_value = torch.cat([l_neg, r_neg]).cuda()
+            new_value = torch.cat([l_neg, r_neg])
 
             self.replay_matrix = self.replay_matrix.index_put(index, new_value)
             if self.replay_ready == 0:
                 num = torch.sum(self.replay_matrix < 0)
-                if num == self.last_num:
-                    self.replay_ready = 1
-                    print("-----------------------------------------")
-                    print("begin replay!")
-                    print("-----------------------------------------")
-                else:
-                    self.last_num = num
+                self.replay_stalled |= num == self.last_num
+                self.last_num = num
         else:
-            loss_joi = self.criterion_cl_joint(joint_emb, batch)
+            loss_joi = self.criterion_cl_joint(joint_emb, batch_emb, queue=self.queue_joint, link_ids=batch)
 
-        in_loss, in_info = self.inner_view_loss(gph_emb, rel_emb, att_emb, img_emb, name_emb, char_emb, batch)
-        out_loss, out_info = self.inner_view_loss(gph_emb_hid, rel_emb_hid, att_emb_hid, img_emb_hid, name_emb_hid, char_emb_hid, batch)
+        in_loss, in_info = self.inner_view_loss(gph_emb, rel_emb, att_emb, img_emb, name_emb, char_emb, batch_emb,
+                                                queue=self.queue_in, link_ids=batch)
+        out_loss, out_info = self.inner_view_loss(gph_emb_hid, rel_emb_hid, att_emb_hid, img_emb_hid, name_emb_hid, char_emb_hid, batch_emb,
+                                                  queue=self.queue_out, link_ids=batch)
 
         loss_all = loss_joi + in_loss + out_loss
-        domain_align_loss = self._domain_align_loss(joint_emb, batch)
+        domain_align_loss = self._domain_align_loss(joint_emb, batch_emb)
         if domain_align_loss is not None and self.args.domain_align_weight > 0:
             loss_all = loss_all + self.args.domain_align_weight * domain_align_loss
-        missing_align_loss = self._missing_aware_img_align_loss(img_emb, batch)
+        missing_align_loss = self._missing_aware_img_align_loss(img_emb, batch_emb, ent_ids)
         if missing_align_loss is not None and self.args.missing_align_weight > 0:
             loss_all = loss_all + self.args.missing_align_weight * missing_align_loss
 
         source_select_loss = in_info["source_loss"] + out_info["source_loss"]
 
+        # detached tensors: the runner accumulates them on the device and reads them back every --log_steps
         loss_dic = {
-            "joint_Intra_modal": loss_joi.item(),
-            "Intra_modal": in_loss.item(),
-            "domain_align": domain_align_loss.item() if domain_align_loss is not None else 0.0,
-            "missing_align": missing_align_loss.item() if missing_align_loss is not None else 0.0,
-            "source_select": source_select_loss.item() if torch.is_tensor(source_select_loss) else 0.0,
+            "joint_Intra_modal": loss_joi.detach(),
+            "Intra_modal": in_loss.detach(),
+            "domain_align": domain_align_loss.detach() if domain_align_loss is not None else 0.0,
+            "missing_align": missing_align_loss.detach() if missing_align_loss is not None else 0.0,
+            "source_select": source_select_loss.detach() if torch.is_tensor(source_select_loss) else 0.0,
         }
         for k, v in in_info.get("source_weights", {}).items():
             loss_dic[f"in_{k}"] = v
@@ -183,15 +206,13 @@ class MEAformer(nn.Module):
 
         return gph_emb, rel_emb, att_emb, img_emb, name_emb, char_emb, joint_emb
 
-    def inner_view_loss(self, gph_emb, rel_emb, att_emb, img_emb, name_emb, char_emb, train_ill):
-        modal_losses = {
-            "gcn": self.criterion_cl(gph_emb, train_ill) if gph_emb is not None else None,
-            "rel": self.criterion_cl(rel_emb, train_ill) if rel_emb is not None else None,
-            "att": self.criterion_cl(att_emb, train_ill) if att_emb is not None else None,
-            "img": self.criterion_cl(img_emb, train_ill) if img_emb is not None else None,
-            "name": self.criterion_cl(name_emb, train_ill) if name_emb is not None else None,
-            "char": self.criterion_cl(char_emb, train_ill) if char_emb is not None else None,
-        }
+    def inner_view_loss(self, gph_emb, rel_emb, att_emb, img_emb, name_emb, char_emb, train_ill, queue=None, link_ids=None):
+        modal_embs = {"gcn": gph_emb, "rel": rel_emb, "att": att_emb, "img": img_emb, "name": name_emb, "char": char_emb}
+        active = [name for name, emb in modal_embs.items() if emb is not None]
+        modal_losses = dict.fromkeys(modal_embs)
+        if len(active) > 0:
+            losses = self.criterion_cl([modal_embs[name] for name in active], train_ill, queue=queue, link_ids=link_ids)
+            modal_losses.update(zip(active, losses.unbind(0)))
 
         zero = torch.tensor(0.0, device=self.img_features.device)
         total_loss = self.multi_loss_layer([
@@ -227,8 +248,51 @@ class MEAformer(nn.Module):
         else:
             return gph_emb, img_emb, rel_emb, att_emb, name_emb, char_emb, joint_emb, hidden_states
 
+    def subgraph_emb_generat(self, ent_ids):
+        """
+        Embeddings of ent_ids only: the structure encoder runs on their k-hop subgraph
+        and the modality encoders and fusion on their rows. Same outputs as
+        joint_emb_generat(only_joint=False)[...][ent_ids].
+        """
+        subset, sub_adj, mapping = k_hop_subgraph(ent_ids, self.adj, self.multimodal_encoder.num_hops)
+        gph_emb, img_emb, rel_emb, att_emb, \
+            name_emb, char_emb, joint_emb, hidden_states, weight_norm = self.multimodal_encoder(self.input_idx[subset],
+                                                                                                sub_adj,
+                                                                                                self.img_features[ent_ids],
+                                                                                                self.rel_features.index_select(0, ent_ids),
+                                                                                                self.att_features.index_select(0, ent_ids),
+                                                                                                self.name_features[ent_ids] if self.name_features is not None else None,
+                                                                                                self.char_features.index_select(0, ent_ids) if self.char_features is not None else None,
+                                                                                                target_idx=mapping)
+        return gph_emb, img_emb, rel_emb, att_emb, name_emb, char_emb, joint_emb, hidden_states
+
+    def _subgraph_batch(self, batch, neg_l=None, neg_r=None):
+        # entities touched by the loss, and batch/negatives relabelled to rows of their embeddings
+        parts = [batch.reshape(-1)] + [neg for neg in (neg_l, neg_r) if neg is not None]
+        ent_ids, inverse = torch.unique(torch.cat(parts), return_inverse=True)
+        batch_local = inverse[:batch.numel()].view_as(batch)
+        neg_l_local, neg_r_local = None, None
+        if neg_l is not None:
+            start = batch.numel()
+            neg_l_local = inverse[start:start + neg_l.shape[0]]
+            neg_r_local = inverse[start + neg_l.shape[0]:]
+        return ent_ids, batch_local, neg_l_local, neg_r_local
+
+    def update_replay_ready(self):
+        if self.args.replay and not self.replay_ready and bool(self.replay_stalled):
+            self.replay_ready = 1
+            print("-----------------------------------------")
+            print("begin replay!")
+            print("-----------------------------------------")
+
     # --------- share ---------------
 
+    def reset_queues(self):
+        """Empty the negative queues, e.g. after loading other weights: their embeddings are stale."""
+        for queue in (self.queue_in, self.queue_out, self.queue_joint):
+            if queue is not None:
+                queue.reset()
+
     def _get_img_dim(self, kgs):
         if isinstance(kgs["images_list"], list):
             img_dim = kgs["images_list"][0].shape[1]
@@ -236,33 +300,42 @@ class MEAformer(nn.Module):
             img_dim = kgs["images_list"].shape[1]
         return img_dim
 
-    def Iter_new_links(self, epoch, left_non_train, final_emb, right_non_train, new_links=[]):
+    def Iter_new_links(self, epoch, left_non_train, final_emb, right_non_train, new_links=None):
+        """
+        left_non_train / right_non_train: index arrays of the entities not in the train set
+        new_links: (K, 2) array of the candidate links of the previous call
+        returns the mutual nearest neighbours, every semi_learn_step * 5 epochs restricted to
+        those already in new_links (confirmation)
+        """
+        if new_links is None:
+            new_links = np.zeros((0, 2), dtype=np.int64)
         if len(left_non_train) == 0 or len(right_non_train) == 0:
             return new_links
-        distance_list = []
-        for i in np.arange(0, len(left_non_train), 1000):
-            d = pairwise_distances(final_emb[left_non_train[i:i + 1000]], final_emb[right_non_train])
-            distance_list.append(d)
-        distance = torch.cat(distance_list, dim=0)
-        preds_l = torch.argmin(distance, dim=1).cpu().numpy().tolist()
-        preds_r = torch.argmin(distance.t(), dim=1).cpu().numpy().tolist()
-        del distance_list, distance, final_emb
-        if (epoch + 1) % (self.args.semi_learn_step * 5) == self.args.semi_learn_step:
-            new_links = [(left_non_train[i], right_non_train[p]) for i, p in enumerate(preds_l) if preds_r[p] == i]
-        else:
-            new_links = [(left_non_train[i], right_non_train[p]) for i, p in enumerate(preds_l) if (preds_r[p] == i) and ((left_non_train[i], right_non_train[p]) in new_links)]
-
-        return new_links
-
-    def data_refresh(self, logger, train_ill, test_ill_, left_non_train, right_non_train, new_links=[]):
+        left_non_train = np.asarray(left_non_train, dtype=np.int64)
+        right_non_train = np.asarray(right_non_train, dtype=np.int64)
+        left_idx = torch.from_numpy(left_non_train).to(final_emb.device)
+        right_idx = torch.from_numpy(right_non_train).to(final_emb.device)
+        csls_k = self.args.csls_k if self.args.il_csls else 0
+        left_pos, right_pos, _ = mutual_nearest_neighbours(final_emb[left_idx], final_emb[right_idx], distance=2,
+                                                            csls_k=csls_k, block_size=self.args.eval_block_size)
+        del final_emb
+        links = np.stack([left_non_train[left_pos.cpu().numpy()], right_non_train[right_pos.cpu().numpy()]], axis=1)
+        if (epoch + 1) % (self.args.semi_learn_step * 5) != self.args.semi_learn_step:
+            num = self.kgs["ent_num"]
+            links = links[np.isin(pair_keys(links, num), pair_keys(new_links, num))]
+        return links
+
+    def data_refresh(self, logger, train_ill, test_ill_, left_non_train, right_non_train, new_links=None):
+        if new_links is None:
+            new_links = np.zeros((0, 2), dtype=np.int64)
         if len(new_links) != 0 and (len(left_non_train) != 0 and len(right_non_train) != 0):
-            new_links_select = new_links
-            train_ill = np.vstack((train_ill, np.array(new_links_select)))
-            num_true = len([nl for nl in new_links_select if nl in test_ill_])
+            new_links_select = np.asarray(new_links, dtype=np.int64).reshape(-1, 2)
+            train_ill = np.vstack((train_ill, new_links_select))
+            num = self.kgs["ent_num"]
+            num_true = int(np.isin(pair_keys(new_links_select, num), pair_keys(test_ill_, num)).sum())
             # remove from left/right_non_train
-            for nl in new_links_select:
-                left_non_train.remove(nl[0])
-                right_non_train.remove(nl[1])
+            left_non_train = left_non_train[~np.isin(left_non_train, new_links_select[:, 0])]
+            right_non_train = right_non_train[~np.isin(right_non_train, new_links_select[:, 1])]
 
             if self.args.rank == 0:
                 logger.info(f"#new_links_select:{len(new_links_select)}")
@@ -271,7 +344,7 @@ class MEAformer(nn.Module):
                 logger.info(f"true link ratio: {(100 * num_true / len(new_links_select)):.1f}%")
                 logger.info(f"#entity not in train set: {len(left_non_train)} (left) {len(right_non_train)} (right)")
 
-            new_links = []
+            new_links = np.zeros((0, 2), dtype=np.int64)
         else:
             logger.info("len(new_links) is 0")
 
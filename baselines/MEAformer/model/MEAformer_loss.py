@@ -33,7 +33,7 @@ class CustomMultiLossLayer(nn.Module):
 
 class icl_loss(nn.Module):
 
-    def __init__(self, tau=0.05, ab_weight=0.5, n_view=2, intra_weight=1.0, inversion=False, replay=False, neg_cross_kg=False):
+    def __init__(self, tau=0.05, ab_weight=0.5, n_view=2, intra_weight=1.0, inversion=False, replay=False, neg_cross_kg=False, block_size=0):
         super(icl_loss, self).__init__()
         self.tau = tau
         self.sim = cosine_sim
@@ -43,17 +43,20 @@ class icl_loss(nn.Module):
         self.inversion = inversion
         self.replay = replay
         self.neg_cross_kg = neg_cross_kg
+        # > 0: logits computed and recomputed (backward) by blocks of rows, see chunked_icl_loss
+        self.block_size = block_size
 
-    def softXEnt(self, target, logits, replay=False, neg_cross_kg=False):
+    def softXEnt(self, target, logits, replay=False, neg_cross_kg=False, num_queue=0):
         # torch.Size([2239, 4478])
 
         logprobs = F.log_softmax(logits, dim=1)
         loss = -(target * logprobs).sum() / logits.shape[0]
         if replay:
-            logits = logits
-            idx = torch.arange(start=0, end=logprobs.shape[0], dtype=torch.int64).cuda()
+            # hard negatives are mined among the batch / replay columns, not the queued entities
+            logits = logits[:, :logits.shape[1] - num_queue]
+            idx = torch.arange(start=0, end=logprobs.shape[0], dtype=torch.int64, device=logits.device)
             stg_neg = logits.argmax(dim=1)
-            new_value = torch.zeros(logprobs.shape[0]).cuda()
+            new_value = torch.zeros(logprobs.shape[0], device=logits.device)
             index = (
                 idx,
                 stg_neg,
@@ -69,7 +72,7 @@ class icl_loss(nn.Module):
     # train_links[:, 0]: shape: (2239,)
     # array([11303,  2910,  2072, ..., 10504, 13555,  8416], dtype=int32)
 
-    def forward(self, emb, train_links, neg_l=None, neg_r=None, norm=True):
+    def forward(self, emb, train_links, neg_l=None, neg_r=None, norm=True, queue=None, link_ids=None):
         if norm:
             emb = F.normalize(emb, dim=1)
         num_ent = emb.shape[0]
@@ -87,20 +90,31 @@ class icl_loss(nn.Module):
         hidden1_large = hidden1
         hidden2_large = hidden2
 
+        # extra negatives of the other KG from the memory queue (EmbeddingQueue of this single view)
+        queue_emb, queue_ids = queue.negatives() if queue is not None else (None, None)
+        if queue is not None:
+            link_ids = train_links if link_ids is None else link_ids
+        num_queue = 0 if queue_emb is None else queue_emb.shape[2]
+
+        if self.block_size > 0 and not self.replay and not self.inversion:
+            z = torch.cat([hidden1, hidden2]).unsqueeze(0)
+            loss = chunked_icl_loss(z, temperature, alpha, self.block_size, queue_emb, queue_ids, link_ids)[0]
+            if queue is not None:
+                queue.enqueue(z, link_ids[:, 0], link_ids[:, 1])
+            return loss
+
         if neg_l is None:
-            num_classes = batch_size * n_view
+            num_classes = batch_size * n_view + num_queue
         else:
-            num_classes = batch_size * n_view + neg_l.shape[0]
-            num_classes_2 = batch_size * n_view + neg_r.shape[0]
+            num_classes = batch_size * n_view + neg_l.shape[0] + num_queue
+            num_classes_2 = batch_size * n_view + neg_r.shape[0] + num_queue
 
-        labels = F.one_hot(torch.arange(start=0, end=batch_size, dtype=torch.int64), num_classes=num_classes).float()
-        labels = labels.cuda()
+        arange = torch.arange(start=0, end=batch_size, dtype=torch.int64, device=emb.device)
+        labels = F.one_hot(arange, num_classes=num_classes).float()
         if neg_l is not None:
-            labels_2 = F.one_hot(torch.arange(start=0, end=batch_size, dtype=torch.int64), num_classes=num_classes_2).float()
-            labels_2 = labels_2.cuda()
+            labels_2 = F.one_hot(arange, num_classes=num_classes_2).float()
 
-        masks = F.one_hot(torch.arange(start=0, end=batch_size, dtype=torch.int64), num_classes=batch_size)
-        masks = masks.cuda().float()
+        masks = F.one_hot(arange, num_classes=batch_size).float()
         logits_aa = torch.matmul(hidden1, torch.transpose(hidden1_large, 0, 1)) / temperature
         logits_aa = logits_aa - masks * LARGE_NUM
 
@@ -128,18 +142,23 @@ class icl_loss(nn.Module):
             else:
                 logits_a = torch.cat([logits_ab, logits_aa, logits_ana], dim=1)
                 logits_b = torch.cat([logits_ba, logits_bb, logits_bnb], dim=1)
+        if queue_emb is not None:
+            logits_a = torch.cat([logits_a, queue_logits(hidden1, link_ids[:, 1], queue_emb[0, 1], queue_ids[1], temperature, LARGE_NUM)], dim=1)
+            logits_b = torch.cat([logits_b, queue_logits(hidden2, link_ids[:, 0], queue_emb[0, 0], queue_ids[0], temperature, LARGE_NUM)], dim=1)
+        if queue is not None:
+            queue.enqueue(torch.cat([hidden1, hidden2]).unsqueeze(0), link_ids[:, 0], link_ids[:, 1])
 
         if self.replay:
-            loss_a, a_neg_idx = self.softXEnt(labels, logits_a, replay=True, neg_cross_kg=self.neg_cross_kg)
+            loss_a, a_neg_idx = self.softXEnt(labels, logits_a, replay=True, neg_cross_kg=self.neg_cross_kg, num_queue=num_queue)
             if neg_l is not None:
-                loss_b, b_neg_idx = self.softXEnt(labels_2, logits_b, replay=True, neg_cross_kg=self.neg_cross_kg)
+                loss_b, b_neg_idx = self.softXEnt(labels_2, logits_b, replay=True, neg_cross_kg=self.neg_cross_kg, num_queue=num_queue)
                 #
-                a_ea_cand = torch.cat([train_links[:, 1], train_links[:, 0], neg_l]).cuda()
-                b_ea_cand = torch.cat([train_links[:, 0], train_links[:, 1], neg_r]).cuda()
+                a_ea_cand = torch.cat([train_links[:, 1], train_links[:, 0], neg_l])
+                b_ea_cand = torch.cat([train_links[:, 0], train_links[:, 1], neg_r])
             else:
-                loss_b, b_neg_idx = self.softXEnt(labels, logits_b, replay=True, neg_cross_kg=self.neg_cross_kg)
-                a_ea_cand = torch.cat([train_links[:, 1], train_links[:, 0]]).cuda()
-                b_ea_cand = torch.cat([train_links[:, 0], train_links[:, 1]]).cuda()
+                loss_b, b_neg_idx = self.softXEnt(labels, logits_b, replay=True, neg_cross_kg=self.neg_cross_kg, num_queue=num_queue)
+                a_ea_cand = torch.cat([train_links[:, 1], train_links[:, 0]])
+                b_ea_cand = torch.cat([train_links[:, 0], train_links[:, 1]])
 
             a_neg = a_ea_cand[a_neg_idx]
             b_neg = b_ea_cand[b_neg_idx]
@@ -149,3 +168,222 @@ class icl_loss(nn.Module):
             loss_a = self.softXEnt(labels, logits_a)
             loss_b = self.softXEnt(labels, logits_b)
             return alpha * loss_a + (1 - alpha) * loss_b
+
+
+class multi_view_icl_loss(nn.Module):
+    """
+    icl_loss (n_view=2, no replay / inversion) of several modalities at once.
+    The views are zero-padded to a common width and stacked into (M, 2B, D),
+    so that [[aa, ab], [ba, bb]] of every modality is a single bmm; the diagonal
+    of aa / bb is masked and the aligned entity is an index target.
+    Returns the (M,) per-modality losses.
+    With block_size > 0 the (M, 2B, 2B) logits are never materialized (chunked_icl_loss).
+    """
+
+    def __init__(self, tau=0.05, ab_weight=0.5, block_size=0):
+        super(multi_view_icl_loss, self).__init__()
+        self.tau = tau
+        self.weight = ab_weight  # the factor of a->b and b<-a
+        self.block_size = block_size
+
+    def forward(self, emb_list, train_links, norm=True, queue=None, link_ids=None):
+        """
+        queue: EmbeddingQueue of these views, whose entries of the other KG are extra negatives
+        (the batch is enqueued afterwards); link_ids: entity ids of train_links when the
+        embeddings are rows of a subgraph
+        """
+        LARGE_NUM = 1e9
+        batch_size = train_links.shape[0]
+        pair_ids = torch.cat([train_links[:, 0], train_links[:, 1]])
+        width = max(emb.shape[1] for emb in emb_list)
+        views = []
+        for emb in emb_list:
+            z = emb[pair_ids]
+            if norm:
+                z = F.normalize(z, dim=1)
+            views.append(F.pad(z, (0, width - z.shape[1])))
+        z = torch.stack(views)
+
+        if self.block_size > 0:
+            link_ids = train_links if link_ids is None else link_ids
+            queue_emb, queue_ids = queue.negatives() if queue is not None else (None, None)
+            loss = chunked_icl_loss(z, self.tau, self.weight, self.block_size, queue_emb, queue_ids, link_ids)
+            if queue is not None:
+                queue.enqueue(z, link_ids[:, 0], link_ids[:, 1])
+            return loss
+
+        # 1/tau folded into one (M, 2B, D) operand, the diagonal masked in place
+        logits = torch.bmm(z, (z / self.tau).transpose(1, 2))
+        eye = torch.eye(2 * batch_size, dtype=torch.bool, device=z.device)
+        logits.masked_fill_(eye, -LARGE_NUM)
+
+        if queue is not None:
+            link_ids = train_links if link_ids is None else link_ids
+            queue_emb, queue_ids = queue.negatives()
+            if queue_emb is not None:
+                # a against the queued right entities, b against the queued left ones
+                logits_qa = queue_logits(z[:, :batch_size], link_ids[:, 1], queue_emb[:, 1], queue_ids[1], self.tau, LARGE_NUM)
+                logits_qb = queue_logits(z[:, batch_size:], link_ids[:, 0], queue_emb[:, 0], queue_ids[0], self.tau, LARGE_NUM)
+                logits = torch.cat([logits, torch.cat([logits_qa, logits_qb], dim=1)], dim=2)
+            queue.enqueue(z, link_ids[:, 0], link_ids[:, 1])
+
+        # row i of a is aligned with column B + i (b), and conversely
+        arange = torch.arange(2 * batch_size, device=z.device)
+        target = ((arange + batch_size) % (2 * batch_size)).repeat(len(emb_list))
+        loss = F.cross_entropy(logits.reshape(-1, logits.shape[-1]), target, reduction="none")
+        loss = loss.view(len(emb_list), 2, batch_size).mean(dim=2)
+        return self.weight * loss[:, 0] + (1 - self.weight) * loss[:, 1]
+
+
+class EmbeddingQueue(nn.Module):
+    """
+    MoCo-style memory of the (detached, normalized) embeddings of the last
+    `size` left and right entities of the training pairs, for one or several views,
+    used as extra negatives of the contrastive losses.
+    Entries older than `max_age` enqueue steps (0: no limit) are ignored.
+    """
+
+    def __init__(self, size, max_age=0):
+        super(EmbeddingQueue, self).__init__()
+        self.size = size
+        self.max_age = max_age
+        self.ptr = 0
+        self.num_step = 0
+        # allocated at the first enqueue: (V, 2, size, D) embeddings, (2, size) entity ids / enqueue steps
+        self.register_buffer("emb", None, persistent=False)
+        self.register_buffer("ids", None, persistent=False)
+        self.register_buffer("stamp", None, persistent=False)
+
+    def reset(self):
+        self.ptr = 0
+        self.num_step = 0
+        self.emb, self.ids, self.stamp = None, None, None
+
+    def negatives(self):
+        """
+        (V, 2, size, D) embeddings and (2, size) entity ids of the two sides,
+        -1 for the empty or stale slots; (None, None) while empty.
+        """
+        if self.emb is None:
+            return None, None
+        # a copy: the losses may keep the ids for their backward while the batch is enqueued
+        if self.max_age > 0:
+            return self.emb, self.ids.masked_fill(self.num_step - self.stamp > self.max_age, -1)
+        return self.emb, self.ids.clone()
+
+    @torch.no_grad()
+    def enqueue(self, z, left_ids, right_ids):
+        """
+        z: (V, 2B, D) embeddings of the B left then the B right entities of the batch
+        """
+        batch_size = left_ids.shape[0]
+        z = z.detach().view(z.shape[0], 2, batch_size, z.shape[-1])
+        ids = torch.stack([left_ids, right_ids])
+        if batch_size > self.size:
+            z, ids, batch_size = z[:, :, -self.size:], ids[:, -self.size:], self.size
+        if self.emb is None:
+            self.emb = z.new_zeros(z.shape[0], 2, self.size, z.shape[-1])
+            self.ids = ids.new_full((2, self.size), -1)
+            self.stamp = ids.new_zeros((2, self.size))
+        self.num_step += 1
+        slots = (torch.arange(batch_size, device=ids.device) + self.ptr) % self.size
+        self.emb.index_copy_(2, slots, z.to(self.emb.dtype))
+        self.ids.index_copy_(1, slots, ids)
+        self.stamp.index_fill_(1, slots, self.num_step)
+        self.ptr = (self.ptr + batch_size) % self.size
+
+
+def queue_logits(anchor, positive_ids, queue_emb, queue_ids, tau, large_num=1e9):
+    """
+    anchor: (..., B, D) normalized rows, queue_emb: (..., Q, D), queue_ids: (Q,)
+    logits of the anchors against the queued entities, the empty / stale slots and
+    the queued copies of each anchor's positive (false negatives) masked out.
+    """
+    logits = torch.matmul(anchor, (queue_emb / tau).transpose(-1, -2))
+    mask = (queue_ids.unsqueeze(0) < 0) | (queue_ids.unsqueeze(0) == positive_ids.unsqueeze(1))
+    return logits.masked_fill(mask, -large_num)
+
+
+def _masked_block_logits(anchor, cand, self_col, pos_ids, queue_ids, tau, large_num):
+    """
+    (M, b, K) logits of a block of anchors against all the candidates, each anchor's own
+    column masked, and the last Q (queued) columns masked where empty / stale or equal to
+    the anchor's positive
+    """
+    logits = torch.matmul(anchor, cand.transpose(-1, -2)).div_(tau)
+    num_row, num_cand = anchor.shape[-2], cand.shape[-2]
+    mask = torch.zeros(num_row, num_cand, dtype=torch.bool, device=anchor.device)
+    mask[torch.arange(num_row, device=anchor.device), self_col] = True
+    if queue_ids is not None:
+        num_queue = queue_ids.shape[0]
+        mask[:, num_cand - num_queue:] = (queue_ids.unsqueeze(0) < 0) | (queue_ids.unsqueeze(0) == pos_ids.unsqueeze(1))
+    return logits.masked_fill_(mask, -large_num)
+
+
+class ChunkedContrastiveFunction(torch.autograd.Function):
+    """
+    Row-wise cross-entropy of anchor (M, R, D) against cand (M, K, D), target (R,) column
+    indices, computed by blocks of `block_size` rows: only the (R,) log-sum-exp are kept
+    for the backward, which recomputes the logits of each block.
+    Memory is O(M * block_size * K) instead of O(M * R * K).
+    """
+    LARGE_NUM = 1e9
+
+    @staticmethod
+    def forward(ctx, anchor, cand, target, self_col, pos_ids, queue_ids, tau, block_size):
+        num_view, num_row = anchor.shape[0], anchor.shape[1]
+        loss = anchor.new_empty(num_view, num_row)
+        lse = anchor.new_empty(num_view, num_row)
+        for start in range(0, num_row, block_size):
+            end = min(start + block_size, num_row)
+            logits = _masked_block_logits(anchor[:, start:end], cand, self_col[start:end],
+                                          pos_ids[start:end] if pos_ids is not None else None, queue_ids, tau, ChunkedContrastiveFunction.LARGE_NUM)
+            lse[:, start:end] = torch.logsumexp(logits, dim=-1)
+            target_logits = logits.gather(-1, target[start:end].view(1, -1, 1).expand(num_view, -1, 1)).squeeze(-1)
+            loss[:, start:end] = lse[:, start:end] - target_logits
+        ctx.save_for_backward(anchor, cand, target, self_col, pos_ids, queue_ids, lse)
+        ctx.tau = tau
+        ctx.block_size = block_size
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        anchor, cand, target, self_col, pos_ids, queue_ids, lse = ctx.saved_tensors
+        tau, block_size = ctx.tau, ctx.block_size
+        num_view, num_row = anchor.shape[0], anchor.shape[1]
+        grad_anchor = torch.zeros_like(anchor) if ctx.needs_input_grad[0] else None
+        grad_cand = torch.zeros_like(cand) if ctx.needs_input_grad[1] else None
+        for start in range(0, num_row, block_size):
+            end = min(start + block_size, num_row)
+            logits = _masked_block_logits(anchor[:, start:end], cand, self_col[start:end],
+                                          pos_ids[start:end] if pos_ids is not None else None, queue_ids, tau, ChunkedContrastiveFunction.LARGE_NUM)
+            # d loss / d logits = softmax - onehot(target), then through the 1/tau scaling
+            grad_logits = logits.sub_(lse[:, start:end].unsqueeze(-1)).exp_()
+            grad_logits.scatter_add_(-1, target[start:end].view(1, -1, 1).expand(num_view, -1, 1),
+                                     grad_logits.new_full((num_view, end - start, 1), -1.))
+            grad_logits.mul_(grad_output[:, start:end].unsqueeze(-1) / tau)
+            if grad_anchor is not None:
+                grad_anchor[:, start:end] = torch.matmul(grad_logits, cand)
+            if grad_cand is not None:
+                grad_cand += torch.matmul(grad_logits.transpose(-1, -2), anchor[:, start:end])
+        return grad_anchor, grad_cand, None, None, None, None, None, None
+
+
+def chunked_icl_loss(z, tau, ab_weight, block_size, queue_emb=None, queue_ids=None, link_ids=None):
+    """
+    (M,) icl losses of z: (M, 2B, D), the normalized embeddings of the B left then the B right
+    entities of the pairs, with ChunkedContrastiveFunction; queue_emb / queue_ids
+    (EmbeddingQueue.negatives) add the queued entities of the other KG as negatives.
+    """
+    batch_size = z.shape[1] // 2
+    arange = torch.arange(batch_size, device=z.device)
+    anchor_a, anchor_b = z[:, :batch_size], z[:, batch_size:]
+    if queue_emb is None:
+        loss_a = ChunkedContrastiveFunction.apply(anchor_a, z, arange + batch_size, arange, None, None, tau, block_size)
+        loss_b = ChunkedContrastiveFunction.apply(anchor_b, z, arange, arange + batch_size, None, None, tau, block_size)
+    else:
+        cand_a = torch.cat([z, queue_emb[:, 1].to(z.dtype)], dim=1)
+        cand_b = torch.cat([z, queue_emb[:, 0].to(z.dtype)], dim=1)
+        loss_a = ChunkedContrastiveFunction.apply(anchor_a, cand_a, arange + batch_size, arange, link_ids[:, 1], queue_ids[1], tau, block_size)
+        loss_b = ChunkedContrastiveFunction.apply(anchor_b, cand_b, arange, arange + batch_size, link_ids[:, 0], queue_ids[0], tau, block_size)
+    return ab_weight * loss_a.mean(dim=1) + (1 - ab_weight) * loss_b.mean(dim=1)
@@ -28,7 +28,8 @@ class MformerFusion(nn.Module):
         self.modal_num = modal_num
         self.fusion_layer = nn.ModuleList([BertLayer(args) for _ in range(args.num_hidden_layers)])
         # self.type_embedding = nn.Embedding(args.inner_view_num, args.hidden_size)
-        self.type_id = torch.tensor([0, 1, 2, 3, 4, 5]).cuda()
+        # follows the module across devices, not saved in the state_dict
+        self.register_buffer("type_id", torch.tensor([0, 1, 2, 3, 4, 5]), persistent=False)
 
     def forward(self, embs):
         embs = [embs[idx] for idx in range(len(embs)) if embs[idx] is not None]
@@ -36,8 +37,10 @@ class MformerFusion(nn.Module):
 
         hidden_states = torch.stack(embs, dim=1)
         bs = hidden_states.shape[0]
+        # only the attention probabilities of the last layer are used (weight_norm)
+        num_layer = len(self.fusion_layer)
         for i, layer_module in enumerate(self.fusion_layer):
-            layer_outputs = layer_module(hidden_states, output_attentions=True)
+            layer_outputs = layer_module(hidden_states, output_attentions=(i == num_layer - 1))
             hidden_states = layer_outputs[0]
         # torch.Size([30355, 5, 4, 4])
         # attention_pro = layer_outputs[1]
@@ -51,6 +54,13 @@ class MformerFusion(nn.Module):
         return joint_emb, hidden_states, weight_norm
 
 
+def sparse_linear(fc, x):
+    # fc(x) for a sparse x: sparse-dense matmul, cost in nnz(x)
+    if x.is_sparse:
+        return torch.sparse.mm(x, fc.weight.t()) + fc.bias
+    return fc(x)
+
+
 class MultiModalEncoder(nn.Module):
     """
     entity embedding: (ent_num, input_dim)
@@ -63,7 +73,8 @@ class MultiModalEncoder(nn.Module):
                  img_feature_dim,
                  char_feature_dim=None,
                  use_project_head=False,
-                 attr_input_dim=1000):
+                 attr_input_dim=1000,
+                 rel_input_dim=1000):
         super(MultiModalEncoder, self).__init__()
 
         self.args = args
@@ -90,7 +101,7 @@ class MultiModalEncoder(nn.Module):
         # Modal Encoder
         #########################
 
-        self.rel_fc = nn.Linear(1000, attr_dim)
+        self.rel_fc = nn.Linear(rel_input_dim, attr_dim)
         self.att_fc = nn.Linear(attr_input_dim, attr_dim)
         self.img_fc = nn.Linear(img_feature_dim, img_dim)
         self.name_fc = nn.Linear(300, char_dim)
@@ -101,10 +112,12 @@ class MultiModalEncoder(nn.Module):
         if self.args.structure_encoder == "gcn":
             self.cross_graph_model = GCN(self.n_units[0], self.n_units[1], self.n_units[2],
                                          dropout=self.args.dropout)
+            self.num_hops = 2
         elif self.args.structure_encoder == "gat":
             self.cross_graph_model = GAT(n_units=self.n_units, n_heads=self.n_heads, dropout=args.dropout,
                                          attn_dropout=args.attn_dropout,
                                          instance_normalization=self.args.instance_normalization, diag=True)
+            self.num_hops = len(self.n_units) - 1
 
         #########################
         # Fusion Encoder
@@ -119,10 +132,15 @@ class MultiModalEncoder(nn.Module):
                 rel_features=None,
                 att_features=None,
                 name_features=None,
-                char_features=None):
+                char_features=None,
+                target_idx=None):
+        # target_idx: rows of the structure embedding to keep when input_idx/adj is a subgraph,
+        # the other modality features are then expected to be given for these rows only
 
         if self.args.w_gcn:
             gph_emb = self.cross_graph_model(self.entity_emb(input_idx), adj)
+            if target_idx is not None:
+                gph_emb = gph_emb[target_idx]
         else:
             gph_emb = None
         if self.args.w_img:
@@ -130,11 +148,11 @@ class MultiModalEncoder(nn.Module):
         else:
             img_emb = None
         if self.args.w_rel:
-            rel_emb = self.rel_fc(rel_features)
+            rel_emb = sparse_linear(self.rel_fc, rel_features)
         else:
             rel_emb = None
         if self.args.w_attr:
-            att_emb = self.att_fc(att_features)
+            att_emb = sparse_linear(self.att_fc, att_features)
         else:
             att_emb = None
         if self.args.w_name and name_features is not None:
@@ -142,7 +160,7 @@ class MultiModalEncoder(nn.Module):
         else:
             name_emb = None
         if self.args.w_char and char_features is not None:
-            char_emb = self.char_fc(char_features)
+            char_emb = sparse_linear(self.char_fc, char_features)
         else:
             char_emb = None
 
@@ -152,6 +170,10 @@ class MultiModalEncoder(nn.Module):
 
 
 class BertSelfAttention(nn.Module):
+    # below this many entities, or under dropout on the CPU (SDPA falls back to its math kernel there),
+    # the explicit softmax is as fast and needs less memory than scaled_dot_product_attention
+    sdpa_min_rows = 4096
+
     def __init__(self, config):
         super().__init__()
         assert config.hidden_size % config.num_attention_heads == 0
@@ -164,42 +186,41 @@ class BertSelfAttention(nn.Module):
 
         self.dropout = nn.Dropout(0.1)
 
-    def transpose_for_scores(self, x: torch.Tensor) -> torch.Tensor:
-        # [8, 8, 3, 256]
-        new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
-        x = x.view(new_x_shape)
-        # return x
-        return x.permute(0, 2, 1, 3)
-
     def forward(
         self,
         hidden_states: torch.Tensor,
         output_attentions=False,
     ):
-        mixed_query_layer = self.query(hidden_states)
-        # [8, 3, 8, 256]
-        key_layer = self.transpose_for_scores(self.key(hidden_states))
-        value_layer = self.transpose_for_scores(self.value(hidden_states))
-
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        # # [8, 3, 8, 8]
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.functional.softmax(attention_scores, dim=-1)
-
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        # [8, 3, 8, 8]
-        attention_probs = self.dropout(attention_probs)
-        context_layer = torch.matmul(attention_probs, value_layer)
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        # one projection for query / key / value, viewed as (N, heads, M, head_size) without copies
+        weight = torch.cat([self.query.weight, self.key.weight, self.value.weight])
+        bias = torch.cat([self.query.bias, self.key.bias, self.value.bias])
+        mixed_layer = F.linear(hidden_states, weight, bias)
+        mixed_layer = mixed_layer.view(mixed_layer.size()[:-1] + (3, self.num_attention_heads, self.attention_head_size))
+        query_layer, key_layer, value_layer = [x.transpose(1, 2) for x in mixed_layer.unbind(dim=2)]
+
+        use_sdpa = (not output_attentions and hidden_states.shape[0] >= self.sdpa_min_rows
+                    and not (self.training and hidden_states.device.type == "cpu"))
+        if not use_sdpa:
+            # Take the dot product between "query" and "key" to get the raw attention scores.
+            # # [8, 3, 8, 8]
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+
+            # Normalize the attention scores to probabilities.
+            attention_probs = nn.functional.softmax(attention_scores, dim=-1)
+
+            # This is actually dropping out entire tokens to attend to, which might
+            # seem a bit unusual, but is taken from the original Transformer paper.
+            # [8, 3, 8, 8]
+            attention_probs = self.dropout(attention_probs)
+            context_layer = torch.matmul(attention_probs, value_layer)
+        else:
+            # fused kernel, the probabilities are never materialized
+            dropout_p = self.dropout.p if self.training else 0.
+            context_layer = F.scaled_dot_product_attention(query_layer, key_layer, value_layer, dropout_p=dropout_p)
+
         # [8, 8, 768]
-        context_layer = context_layer.view(new_context_layer_shape)
+        context_layer = context_layer.transpose(1, 2).reshape(context_layer.shape[0], -1, self.all_head_size)
 
         outputs = (context_layer, attention_probs) if output_attentions else (context_layer,)
         return outputs
@@ -284,18 +305,16 @@ class BertLayer(nn.Module):
             hidden_states,
             output_attentions=output_attentions,
         )
+        # (attention_output, attention_probs if output_attentions)
         if not self.config.use_intermediate:
-            return (self_attention_outputs[0], self_attention_outputs[1])
+            return self_attention_outputs
 
         attention_output = self_attention_outputs[0]
-        # if decoder, the last output is tuple of self-attn cache
-        outputs = self_attention_outputs[1]
-        # present_key_value = self_attention_outputs[-1]
         # torch.Size([30355, 4, 300])
         layer_output = apply_chunking_to_forward(
             self.feed_forward_chunk, self.chunk_size_feed_forward, self.seq_len_dim, attention_output
         )
-        outputs = (layer_output, outputs)
+        outputs = (layer_output,) + self_attention_outputs[1:]
         # if decoder, return the attn key/values as the last output
         # outputs = outputs + (present_key_value,)
         return outputs
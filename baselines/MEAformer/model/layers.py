@@ -8,8 +8,25 @@ import torch.nn.functional as F
 import pdb
 
 
+def sddmm(indices, x, y, chunk_size=65536):
+    """
+    Sampled dense-dense matmul: out[e] = x[indices[0, e]] . y[indices[1, e]],
+    i.e. (x @ y.t()) read at the nnz positions only, computed over chunks of edges.
+    """
+    num_edge = indices.shape[1]
+    out = torch.empty(num_edge, dtype=x.dtype, device=x.device)
+    for start in range(0, num_edge, chunk_size):
+        row = indices[0, start:start + chunk_size]
+        col = indices[1, start:start + chunk_size]
+        out[start:start + chunk_size] = (x[row] * y[col]).sum(1)
+    return out
+
+
 class SpecialSpmmFunction(torch.autograd.Function):
     """Special function for only sparse region backpropataion layer."""
+    # number of edges whose gradient is computed at once
+    edge_chunk = 65536
+
     @staticmethod
     def forward(ctx, indices, values, shape, b):
         assert indices.requires_grad is False
@@ -23,9 +40,8 @@ class SpecialSpmmFunction(torch.autograd.Function):
         a, b = ctx.saved_tensors
         grad_values = grad_b = None
         if ctx.needs_input_grad[1]:
-            grad_a_dense = grad_output.matmul(b.t())
-            edge_idx = a._indices()[0, :] * ctx.N + a._indices()[1, :]
-            grad_values = grad_a_dense.view(-1)[edge_idx]
+            # d(a @ b)/d(a[i, j]) = grad_output[i] . b[j], only needed on the edges of a
+            grad_values = sddmm(a._indices(), grad_output, b, SpecialSpmmFunction.edge_chunk)
         if ctx.needs_input_grad[3]:
             grad_b = a.t().matmul(grad_output)
         return None, grad_values, None, grad_b
@@ -56,6 +72,8 @@ class MultiHeadGraphAttention(nn.Module):
         self.attn_dropout = attn_dropout
         self.leaky_relu = nn.LeakyReLU(negative_slope=0.2)
         self.special_spmm = SpecialSpmm()
+        self._cached_adj = None
+        self._cached_edges = None
         if bias:
             self.bias = Parameter(torch.Tensor(f_out))
             nn.init.constant_(self.bias, 0)
@@ -69,31 +87,42 @@ class MultiHeadGraphAttention(nn.Module):
             nn.init.xavier_uniform_(self.w)
             nn.init.xavier_uniform_(self.a_src_dst)
 
-    def forward(self, input, adj):
-        output = []
-        for i in range(self.n_head):
-            # pdb.set_trace()
-            N = input.size()[0]
+    def _edges(self, adj):
+        # edge list of adj and its per-head copy on the block-diagonal (n_head*N, n_head*N) graph,
+        # cached as long as the same adj is passed in
+        if self._cached_adj is not adj:
+            N = adj.shape[0]
             edge = adj._indices()
-            if self.diag:
-                h = torch.mul(input, self.w[i])
-            else:
-                h = torch.mm(input, self.w[i])
-
-            edge_h = torch.cat((h[edge[0, :], :], h[edge[1, :], :]), dim=1)  # edge: 2*D x E
-            edge_e = torch.exp(-self.leaky_relu(edge_h.mm(self.a_src_dst[i]).squeeze()))  # edge_e: 1 x E
-            # e_rowsum: N x 1
-            e_rowsum = self.special_spmm(edge, edge_e, torch.Size([N, N]), torch.ones(size=(N, 1)).cuda() if next(self.parameters()).is_cuda else torch.ones(size=(N, 1)))
-            # pdb.set_trace()
-            edge_e = F.dropout(edge_e, self.attn_dropout, training=self.training)   # edge_e: 1 x E
-
-            h_prime = self.special_spmm(edge, edge_e, torch.Size([N, N]), h)
-            h_prime = h_prime.div(e_rowsum)
-
-            output.append(h_prime.unsqueeze(0))
-        # pdb.set_trace()
-        output = torch.cat(output, dim=0)
-        # pdb.set_trace()
+            offset = (torch.arange(self.n_head, device=edge.device) * N).view(-1, 1, 1)
+            block_edge = (edge.unsqueeze(0) + offset).permute(1, 0, 2).reshape(2, -1)
+            self._cached_adj = adj
+            self._cached_edges = (edge, edge[0].expand(self.n_head, -1), block_edge)
+        return self._cached_edges
+
+    def forward(self, input, adj):
+        N = input.size()[0]
+        edge, row, block_edge = self._edges(adj)
+        if self.diag:
+            h = input.unsqueeze(0) * self.w  # h: n_head x N x D
+        else:
+            h = torch.matmul(input, self.w)
+        # [h_i || h_j] . a == h_i . a_src + h_j . a_dst, so no E x 2D tensor is needed
+        score_src = torch.bmm(h, self.a_src_dst[:, :self.f_out]).squeeze(-1)
+        score_dst = torch.bmm(h, self.a_src_dst[:, self.f_out:]).squeeze(-1)
+        edge_s = -self.leaky_relu(score_src[:, edge[0]] + score_dst[:, edge[1]])  # edge_s: n_head x E
+
+        # softmax over the edges of each row, shifted by the row max for stability
+        with torch.no_grad():
+            row_max = torch.full((self.n_head, N), float("-inf"), dtype=edge_s.dtype, device=edge_s.device)
+            row_max = row_max.scatter_reduce(1, row, edge_s, reduce="amax", include_self=False)
+        edge_e = torch.exp(edge_s - row_max.gather(1, row))
+        e_rowsum = torch.zeros((self.n_head, N), dtype=edge_e.dtype, device=edge_e.device).scatter_add(1, row, edge_e)
+        edge_e = edge_e / e_rowsum.gather(1, row)
+        edge_e = F.dropout(edge_e, self.attn_dropout, training=self.training)
+
+        # all heads aggregated by one spmm on the block-diagonal graph
+        output = self.special_spmm(block_edge, edge_e.reshape(-1), torch.Size([self.n_head * N, self.n_head * N]),
+                                   h.reshape(self.n_head * N, -1)).view(self.n_head, N, -1)
         if self.bias is not None:
             return output + self.bias
         else:
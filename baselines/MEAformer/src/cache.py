@@ -0,0 +1,76 @@
+import os
+import os.path as osp
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+# bump when the layout of a cache entry changes
+CACHE_VERSION = 2
+
+
+def file_digest(paths, extra=""):
+    """
+    sha1 of the contents of `paths` (in order) and of an extra string,
+    used as the key of the cache entries built from these files.
+    """
+    sha = hashlib.sha1()
+    sha.update(f"v{CACHE_VERSION}|{extra}".encode("utf-8"))
+    for path in paths:
+        sha.update(osp.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def stat_digest(paths, extra=""):
+    """
+    sha1 of the path, size and modification time of `paths`: a cheaper key for
+    large files (e.g. word embeddings) that are replaced rather than edited.
+    """
+    sha = hashlib.sha1()
+    sha.update(f"v{CACHE_VERSION}|{extra}".encode("utf-8"))
+    for path in paths:
+        stat = os.stat(path)
+        sha.update(f"{osp.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8"))
+    return sha.hexdigest()
+
+
+def cache_entry(cache_root, kind, digest):
+    return osp.join(cache_root, kind, digest)
+
+
+def save_array_cache(path, arrays, meta=None):
+    """
+    Write every array of `arrays` as {name}.npy (so that it can be memory-mapped)
+    plus a meta.json, into a temporary folder renamed to `path` once complete.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(osp.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(osp.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": CACHE_VERSION, "arrays": sorted(arrays.keys()), "meta": meta or {}}, f, indent=2)
+    if osp.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(osp.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+
+
+def load_array_cache(path, mmap_mode="r"):
+    """
+    Arrays written by save_array_cache, memory-mapped by default,
+    and their meta dict; (None, None) if the entry does not exist.
+    """
+    meta_path = osp.join(path, "meta.json")
+    if not osp.exists(meta_path):
+        return None, None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        info = json.load(f)
+    if info.get("version") != CACHE_VERSION:
+        return None, None
+    arrays = {name: np.load(osp.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in info["arrays"]}
+    return arrays, info["meta"]
@@ -1,5 +1,6 @@
 import torch
 import random
+import math
 import json
 import numpy as np
 import pdb
@@ -12,8 +13,10 @@ import torch.nn.functional as F
 from transformers import BertTokenizer
 import torch.distributed
 from tqdm import tqdm
+import scipy.sparse as sp
 
-from .utils import get_topk_indices, get_adjr
+from .utils import get_topk_indices, blocked_topk_indices, mutual_nn_pairs, get_adjr, build_graph_structure, graph_to_sparse_tensor
+from .cache import file_digest, stat_digest, cache_entry, save_array_cache, load_array_cache
 
 
 class EADataset(torch.utils.data.Dataset):
@@ -37,6 +40,75 @@ class Collator_base(object):
         return np.array(batch)
 
 
+class PairBatchIterator(object):
+    """
+    Mini-batches of an (n, 2) array of aligned pairs kept as one int64 tensor on `device`,
+    in place of DataLoader(EADataset, Collator_base) for training: no worker process and no host to device copy.
+    Each epoch (set_epoch) draws a randperm from a generator seeded with seed + epoch.
+    With num_replicas > 1 every rank takes the same shard as DistributedSampler
+    (indices padded to a multiple of num_replicas, rank::num_replicas).
+    append() adds pairs (IL refresh) in amortized O(#new pairs).
+    """
+
+    def __init__(self, pairs, batch_size, device, shuffle=True, seed=0, num_replicas=1, rank=0, drop_last=False):
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.num = 0
+        self._buffer = torch.empty((0, 2), dtype=torch.int64, device=self.device)
+        self.append(pairs)
+
+    @property
+    def data(self):
+        return self._buffer[:self.num]
+
+    def append(self, pairs):
+        pairs = torch.as_tensor(np.asarray(pairs), dtype=torch.int64).reshape(-1, 2).to(self.device)
+        if self.num + len(pairs) > len(self._buffer):
+            buffer = torch.empty((max(2 * len(self._buffer), self.num + len(pairs)), 2), dtype=torch.int64, device=self.device)
+            buffer[:self.num] = self._buffer[:self.num]
+            self._buffer = buffer
+        self._buffer[self.num:self.num + len(pairs)] = pairs
+        self.num += len(pairs)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shard_size(self):
+        return math.ceil(self.num / self.num_replicas)
+
+    def _indices(self):
+        if self.shuffle:
+            generator = torch.Generator(device=self.device)
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.num, generator=generator, device=self.device)
+        else:
+            indices = torch.arange(self.num, device=self.device)
+        if self.num_replicas > 1:
+            total = self._shard_size() * self.num_replicas
+            if total > self.num:
+                indices = torch.cat([indices, indices.repeat(math.ceil(total / self.num))[:total - self.num]])
+            indices = indices[self.rank:total:self.num_replicas]
+        return indices
+
+    def __len__(self):
+        size = self._shard_size()
+        if self.drop_last:
+            return size // self.batch_size
+        return math.ceil(size / self.batch_size)
+
+    def __iter__(self):
+        indices = self._indices()
+        data = self.data
+        for i in range(len(self)):
+            yield data[indices[i * self.batch_size:(i + 1) * self.batch_size]]
+
+
 def load_data(logger, args):
     assert args.data_choice in ["DWY", "DBP15K", "FBYG15K", "FBDB15K"]
     if args.data_choice in ["DWY", "DBP15K", "FBYG15K", "FBDB15K"]:
@@ -51,14 +123,6 @@ def load_data(logger, args):
 def load_eva_data(logger, args):
     file_dir = osp.join(args.data_path, args.data_choice, args.data_split)
     lang_list = [1, 2]
-    ent2id_dict, ills, triples, r_hs, r_ts, ids = read_raw_data(file_dir, lang_list)
-    e1 = os.path.join(file_dir, 'ent_ids_1')
-    e2 = os.path.join(file_dir, 'ent_ids_2')
-    left_ents = get_ids(e1)
-    right_ents = get_ids(e2)
-    ENT_NUM = len(ent2id_dict)
-    REL_NUM = len(r_hs)
-    np.random.shuffle(ills)
     if "V1" in file_dir:
         split = "norm"
         img_vec_path = osp.join(args.data_path, "pkls/dbpedia_wikidata_15k_norm_GA_id_img_feature_dict.pkl")
@@ -73,7 +137,20 @@ def load_eva_data(logger, args):
         img_vec_path = osp.join(args.data_path, "pkls", args.data_split + "_GA_id_img_feature_dict.pkl")
 
     assert osp.exists(img_vec_path)
-    img_features, img_mask = load_img(logger, ENT_NUM, img_vec_path)
+    if args.data_cache:
+        data, meta = load_dataset_cache(args.cache_dir, file_dir, lang_list, img_vec_path, logger, args.rel_topk, args.attr_topk)
+    else:
+        data, meta = compile_dataset(file_dir, lang_list, img_vec_path, args.rel_topk, args.attr_topk)
+    ENT_NUM = meta["ent_num"]
+    REL_NUM = meta["rel_num"]
+    left_ents = data["left_ents"].tolist()
+    right_ents = data["right_ents"].tolist()
+    triples = data["triples"]
+    ills = [tuple(x) for x in data["ills"].tolist()]
+    np.random.shuffle(ills)
+
+    img_features, img_mask = impute_img(logger, data["img_features"], data["img_mask"], data["img_mean"], data["img_std"], meta["img_num"],
+                                        seed=args.random_seed)
     logger.info(f"image feature shape:{img_features.shape}")
 
     if args.word_embedding == "glove":
@@ -90,9 +167,9 @@ def load_eva_data(logger, args):
         assert osp.exists(word2vec_path)
         ent_vec, char_features = load_word_char_features(ENT_NUM, word2vec_path, args, logger)
         name_features = F.normalize(torch.Tensor(ent_vec))
-        char_features = F.normalize(torch.Tensor(char_features))
+        # rows already L2-normalized, kept as a CSR matrix
         logger.info(f"name feature shape:{name_features.shape}")
-        logger.info(f"char feature shape:{char_features.shape}")
+        logger.info(f"char feature shape:{char_features.shape}, nnz:{char_features.nnz}")
 
     if args.unsup:
         mode = args.unsup_mode
@@ -113,19 +190,18 @@ def load_eva_data(logger, args):
     test_left = torch.LongTensor(test_ill[:, 0].squeeze())
     test_right = torch.LongTensor(test_ill[:, 1].squeeze())
 
-    left_non_train = list(set(left_ents) - set(train_ill[:, 0].tolist()))
+    # index arrays (in the previous set-difference order) for the iterative learning bookkeeping
+    left_non_train = np.array(list(set(left_ents) - set(train_ill[:, 0].tolist())), dtype=np.int64)
 
-    right_non_train = list(set(right_ents) - set(train_ill[:, 1].tolist()))
+    right_non_train = np.array(list(set(right_ents) - set(train_ill[:, 1].tolist())), dtype=np.int64)
 
     logger.info(f"#left entity : {len(left_ents)}, #right entity: {len(right_ents)}")
     logger.info(f"#left entity not in train set: {len(left_non_train)}, #right entity not in train set: {len(right_non_train)}")
 
-    rel_features = load_relation(ENT_NUM, triples, 1000)
-    logger.info(f"relation feature shape:{rel_features.shape}")
-    a1 = os.path.join(file_dir, 'training_attrs_1')
-    a2 = os.path.join(file_dir, 'training_attrs_2')
-    att_features = load_attr([a1, a2], ENT_NUM, ent2id_dict, 1000)  # attr
-    logger.info(f"attribute feature shape:{att_features.shape}")
+    rel_features = csr_from_arrays(data, "rel", meta["rel_shape"])
+    logger.info(f"relation feature shape:{rel_features.shape}, nnz:{rel_features.nnz}")
+    att_features = csr_from_arrays(data, "att", meta["att_shape"])  # attr
+    logger.info(f"attribute feature shape:{att_features.shape}, nnz:{att_features.nnz}")
 
     logger.info("-----dataset summary-----")
     logger.info(f"dataset:\t\t {file_dir}")
@@ -137,7 +213,11 @@ def load_eva_data(logger, args):
 
     eval_ill = None
     input_idx = torch.LongTensor(np.arange(ENT_NUM))
-    adj = get_adjr(ENT_NUM, triples, norm=True)
+    if args.data_cache:
+        graph = load_graph_structure(args.cache_dir, file_dir, lang_list, ENT_NUM, triples, logger)
+        adj = graph_to_sparse_tensor(graph, ENT_NUM)
+    else:
+        adj = get_adjr(ENT_NUM, triples, norm=True)
     # pdb.set_trace()
     train_ill = EADataset(train_ill)
     test_ill = EADataset(test_ill)
@@ -156,9 +236,10 @@ def load_eva_data(logger, args):
     }, {"left": left_non_train, "right": right_non_train}, train_ill, test_ill, eval_ill, test_ill_
 
 
-def load_word2vec(path, dim=300):
+def load_word2vec(path, dim=300, vocab=None):
     """
     glove or fasttext embedding
+    vocab: if given, only the (lower-cased) words in it are parsed and kept
     """
     # print('\n', path)
     word2vec = dict()
@@ -166,23 +247,47 @@ def load_word2vec(path, dim=300):
     err_list = []
 
     with open(path, 'r', encoding='utf-8') as file:
-        for line in tqdm(file.readlines(), desc="load word embedding"):
+        for line in tqdm(file, desc="load word embedding"):
+            word = line.split(' ', 1)[0].lower()
+            if vocab is not None and word not in vocab:
+                continue
             line = line.strip('\n').split(' ')
             if len(line) != dim + 1:
                 continue
             try:
-                v = np.array(list(map(float, line[1:])), dtype=np.float64)
-                word2vec[line[0].lower()] = v
-            except:
+                word2vec[word] = np.array(line[1:], dtype=np.float32)
+            except ValueError:
                 err_num += 1
                 err_list.append(line[0])
                 continue
-    file.close()
     print("err list ", err_list)
     print("err num ", err_num)
     return word2vec
 
 
+def load_word2vec_cache(cache_dir, path, vocab, logger, dim=300):
+    """
+    load_word2vec restricted to vocab, stored as a float32 (V, dim) .npy
+    plus the word list and reloaded from cache_dir when the embedding file and vocab did not change.
+    """
+    vocab = sorted(vocab)
+    key = stat_digest([path], extra=f"dim={dim}|" + "\n".join(vocab))
+    entry = cache_entry(cache_dir, "word2vec", key)
+    arrays, _ = load_array_cache(entry)
+    if arrays is not None:
+        logger.info(f"load word embedding from {entry}")
+        return dict(zip(arrays["words"].tolist(), arrays["vectors"]))
+    word2vec = load_word2vec(path, dim, set(vocab))
+    words = list(word2vec.keys())
+    vectors = np.stack([word2vec[w] for w in words]) if words else np.zeros((0, dim), dtype=np.float32)
+    try:
+        save_array_cache(entry, {"words": np.array(words, dtype=str), "vectors": vectors}, meta={"path": path, "num": len(words)})
+        logger.info(f"save word embedding to {entry}")
+    except OSError as e:
+        logger.info(f"[WARN] cannot write word embedding cache {entry}: {e}")
+    return word2vec
+
+
 def load_char_bigram(path):
     """
     character bigrams of translated entity names
@@ -205,87 +310,191 @@ def load_char_bigram(path):
 def load_word_char_features(node_size, word2vec_path, args, logger):
     """
     node_size : ent num
+    returns the (node_size, 300) name features and the row-normalized (node_size, |bigrams|) CSR char features
     """
     name_path = os.path.join(args.data_path, "DBP15K", "translated_ent_name", "dbp_" + args.data_split + ".json")
     assert osp.exists(name_path)
-    save_path_name = os.path.join(args.data_path, "embedding", f"dbp_{args.data_split}_name.pkl")
-    save_path_char = os.path.join(args.data_path, "embedding", f"dbp_{args.data_split}_char.pkl")
+    save_path_name = os.path.join(args.data_path, "embedding", f"dbp_{args.data_split}_name.npy")
+    save_path_char = os.path.join(args.data_path, "embedding", f"dbp_{args.data_split}_char.npz")
     if osp.exists(save_path_name) and osp.exists(save_path_char):
         logger.info(f"load entity name emb from {save_path_name} ... ")
-        ent_vec = pickle.load(open(save_path_name, "rb"))
+        ent_vec = np.load(save_path_name)
         logger.info(f"load entity char emb from {save_path_char} ... ")
-        char_vec = pickle.load(open(save_path_char, "rb"))
+        char_vec = sp.load_npz(save_path_char).tocsr()
         return ent_vec, char_vec
 
-    word_vecs = load_word2vec(word2vec_path)
     ent_names, char2id = load_char_bigram(name_path)
+    vocab = {word.lower() for _, name in ent_names for word in name}
+    if args.data_cache:
+        word_vecs = load_word2vec_cache(args.cache_dir, word2vec_path, vocab, logger)
+    else:
+        word_vecs = load_word2vec(word2vec_path, vocab=vocab)
 
     # generate the word-level features and char-level features
-
-    ent_vec = np.zeros((node_size, 300))
-    char_vec = np.zeros((node_size, len(char2id)))
+    word_rows, words, char_rows, char_cols = [], [], [], []
     for i, name in ent_names:
-        k = 0
         for word in name:
             word = word.lower()
             if word in word_vecs:
-                ent_vec[i] += word_vecs[word]
-                k += 1
+                word_rows.append(i)
+                words.append(word)
             for idx in range(len(word) - 1):
-                char_vec[i, char2id[word[idx:idx + 2]]] += 1
-        if k:
-            ent_vec[i] /= k
-        else:
-            ent_vec[i] = np.random.random(300) - 0.5
+                char_rows.append(i)
+                char_cols.append(char2id[word[idx:idx + 2]])
 
-        if np.sum(char_vec[i]) == 0:
-            char_vec[i] = np.random.random(len(char2id)) - 0.5
-        ent_vec[i] = ent_vec[i] / np.linalg.norm(ent_vec[i])
-        char_vec[i] = char_vec[i] / np.linalg.norm(char_vec[i])
-
-    with open(save_path_name, 'wb') as f:
-        pickle.dump(ent_vec, f)
-    with open(save_path_char, 'wb') as f:
-        pickle.dump(char_vec, f)
+    ent_vec = np.zeros((node_size, 300))
+    if words:
+        np.add.at(ent_vec, np.array(word_rows), np.stack([word_vecs[w] for w in words]))
+    word_num = np.bincount(np.array(word_rows, dtype=np.int64), minlength=node_size)
+    char_num = np.bincount(np.array(char_rows, dtype=np.int64), minlength=node_size)
+    named = np.array([i for i, _ in ent_names], dtype=np.int64)
+    with_word = named[word_num[named] > 0]
+    ent_vec[with_word] /= word_num[with_word, None]
+
+    # entities without any known word / bigram get a random vector (one entity at a time), drawn like
+    # impute_img from a generator seeded with random_seed rather than from the global numpy RNG
+    rng = np.random.default_rng([args.random_seed, 1])
+    char_data = [np.ones(len(char_rows))]
+    for i, _ in ent_names:
+        if word_num[i] == 0:
+            ent_vec[i] = rng.random(300) - 0.5
+        if char_num[i] == 0:
+            char_rows.extend([i] * len(char2id))
+            char_cols.extend(range(len(char2id)))
+            char_data.append(rng.random(len(char2id)) - 0.5)
+    ent_vec[named] = ent_vec[named] / np.linalg.norm(ent_vec[named], axis=1, keepdims=True)
+
+    char_vec = sp.csr_matrix((np.concatenate(char_data), (char_rows, char_cols)), shape=(node_size, len(char2id)))
+    char_vec.sum_duplicates()
+    char_norm = np.sqrt(np.asarray(char_vec.multiply(char_vec).sum(1)).flatten())
+    char_norm[char_norm == 0] = 1.0
+    char_vec = sp.diags(1.0 / char_norm).dot(char_vec).astype(np.float32).tocsr()
+
+    np.save(save_path_name, ent_vec)
+    sp.save_npz(save_path_char, char_vec)
     logger.info("save entity emb done. ")
     return ent_vec, char_vec
 
 
 def visual_pivot_induction(args, left_ents, right_ents, img_features, ills, logger):
-
+    """
+    unsup_k seed links from the similarity of the given features (image, name or char):
+    - greedy: one-to-one greedy matching over the unsup_k*100 most similar pairs
+    - mutual: the unsup_k most similar mutual nearest neighbours
+    """
     l_img_f = img_features[left_ents]  # left images
     r_img_f = img_features[right_ents]  # right images
-
-    img_sim = l_img_f.mm(r_img_f.t())
     topk = args.unsup_k
-    two_d_indices = get_topk_indices(img_sim, topk * 100)
-    del l_img_f, r_img_f, img_sim
+    block_size = args.eval_block_size
 
-    visual_links = []
-    used_inds = []
-    count = 0
-    for ind in two_d_indices:
-        if left_ents[ind[0]] in used_inds:
-            continue
-        if right_ents[ind[1]] in used_inds:
-            continue
-        used_inds.append(left_ents[ind[0]])
-        used_inds.append(right_ents[ind[1]])
-        visual_links.append((left_ents[ind[0]], right_ents[ind[1]]))
-        count += 1
-        if count == topk:
-            break
-
-    count = 0.0
-    for link in visual_links:
-        if link in ills:
-            count = count + 1
-    logger.info(f"{(count / len(visual_links) * 100):.2f}% in true links")
+    if args.unsup_match == "mutual":
+        left_idx, right_idx, _ = mutual_nn_pairs(l_img_f, r_img_f, block_size)
+        left_idx, right_idx = left_idx[:topk].tolist(), right_idx[:topk].tolist()
+        visual_links = [(left_ents[i], right_ents[j]) for i, j in zip(left_idx, right_idx)]
+    else:
+        _, two_d_indices = blocked_topk_indices(l_img_f, r_img_f, topk * 100, block_size)
+        left_used = np.zeros(len(left_ents), dtype=bool)
+        right_used = np.zeros(len(right_ents), dtype=bool)
+        visual_links = []
+        for i, j in two_d_indices.tolist():
+            if left_used[i] or right_used[j]:
+                continue
+            left_used[i] = right_used[j] = True
+            visual_links.append((left_ents[i], right_ents[j]))
+            if len(visual_links) == topk:
+                break
+    del l_img_f, r_img_f
+
+    ill_set = set(map(tuple, ills))
+    count = sum(1 for link in visual_links if link in ill_set)
+    logger.info(f"{(count / max(len(visual_links), 1) * 100):.2f}% in true links")
     logger.info(f"visual links length: {(len(visual_links))}")
-    train_ill = np.array(visual_links, dtype=np.int32)
+    train_ill = np.array(visual_links, dtype=np.int32).reshape(-1, 2)
     return train_ill
 
 
+def compile_dataset(file_dir, lang_list, img_vec_path, topR=1000, topA=1000):
+    """
+    Parse the raw files of one data_choice/data_split into numpy arrays:
+    entity ids, ILLs (file order), triples, relation/attribute features (CSR parts)
+    and the image features of the entities that have one (zeros elsewhere) with their mask.
+    """
+    ent2id_dict, ills, triples, r_hs, r_ts, ids = read_raw_data(file_dir, lang_list)
+    ent_num = len(ent2id_dict)
+    rel_features = load_relation(ent_num, triples, topR)
+    attr_paths = [osp.join(file_dir, f"training_attrs_{lang}") for lang in lang_list]
+    att_features = load_attr(attr_paths, ent_num, ent2id_dict, topA)
+    img_features, img_mask, img_mean, img_std, img_num = read_img(ent_num, img_vec_path)
+    data = {
+        "left_ents": np.array(get_ids(osp.join(file_dir, f"ent_ids_{lang_list[0]}")), dtype=np.int64),
+        "right_ents": np.array(get_ids(osp.join(file_dir, f"ent_ids_{lang_list[1]}")), dtype=np.int64),
+        "ills": np.array(ills, dtype=np.int64).reshape(-1, 2),
+        "triples": np.array(triples, dtype=np.int64).reshape(-1, 3),
+        "img_features": img_features,
+        "img_mask": img_mask,
+        "img_mean": img_mean,
+        "img_std": img_std,
+    }
+    for name, mat in [("rel", rel_features), ("att", att_features)]:
+        data[f"{name}_indptr"] = mat.indptr
+        data[f"{name}_indices"] = mat.indices
+        data[f"{name}_data"] = mat.data
+    meta = {
+        "ent_num": ent_num,
+        "rel_num": len(r_hs),
+        "img_num": img_num,
+        "rel_shape": list(rel_features.shape),
+        "att_shape": list(att_features.shape),
+    }
+    return data, meta
+
+
+def load_dataset_cache(cache_dir, file_dir, lang_list, img_vec_path, logger, topR=1000, topA=1000):
+    """
+    compile_dataset, memory-mapped from cache_dir when the source files did not change.
+    """
+    src_files = [osp.join(file_dir, f"ent_ids_{lang}") for lang in lang_list] + [osp.join(file_dir, "ill_ent_ids")]
+    src_files += [osp.join(file_dir, f"triples_{lang}") for lang in lang_list]
+    src_files += [osp.join(file_dir, f"training_attrs_{lang}") for lang in lang_list] + [img_vec_path]
+    path = cache_entry(cache_dir, "dataset", file_digest(src_files, extra=f"topR={topR}|topA={topA}"))
+    data, meta = load_array_cache(path)
+    if data is not None:
+        logger.info(f"load compiled dataset from {path}")
+        return data, meta
+    data, meta = compile_dataset(file_dir, lang_list, img_vec_path, topR, topA)
+    try:
+        save_array_cache(path, data, meta=meta)
+        logger.info(f"save compiled dataset to {path}")
+    except OSError as e:
+        logger.info(f"[WARN] cannot write dataset cache {path}: {e}")
+    return data, meta
+
+
+def csr_from_arrays(data, name, shape):
+    return sp.csr_matrix((data[f"{name}_data"], data[f"{name}_indices"], data[f"{name}_indptr"]), shape=tuple(shape))
+
+
+def load_graph_structure(cache_dir, file_dir, lang_list, ent_num, triples, logger):
+    """
+    Normalized adjacency (edge list and values, see build_graph_structure),
+    memory-mapped from cache_dir when built before from the same triples files.
+    """
+    triple_paths = [osp.join(file_dir, f"triples_{lang}") for lang in lang_list]
+    path = cache_entry(cache_dir, "graph", file_digest(triple_paths, extra=f"ent_num={ent_num}"))
+    # copy-on-write mapping: writable, so that torch.from_numpy can share it without a copy
+    graph, _ = load_array_cache(path, mmap_mode="c")
+    if graph is not None:
+        logger.info(f"load graph structure from {path}")
+        return {"edge_index": graph["edge_index"], "data": graph["data"]}
+    graph = build_graph_structure(ent_num, triples)
+    try:
+        save_array_cache(path, graph, meta={"file_dir": file_dir, "ent_num": ent_num, "nnz": int(graph["data"].shape[0])})
+        logger.info(f"save graph structure to {path}")
+    except OSError as e:
+        logger.info(f"[WARN] cannot write graph cache {path}: {e}")
+    return graph
+
+
 def read_raw_data(file_dir, lang=[1, 2]):
     """
     Read DBP15k/DWY15k dataset.
@@ -371,52 +580,55 @@ def get_ent2id(fns):
     return ent2id
 
 
+def most_frequent(values, top_k):
+    """
+    Column of each entry of `values` among its top_k most frequent distinct values
+    (-1 for the others). Ties are broken by first occurrence, like Counter.most_common.
+    """
+    uniq, first, inverse, counts = np.unique(values, return_index=True, return_inverse=True, return_counts=True)
+    order = np.lexsort((first, -counts))[:top_k]
+    column = np.full(len(uniq), -1, dtype=np.int64)
+    column[order] = np.arange(len(order))
+    return column[inverse.reshape(-1)], len(order)
+
+
 # The most frequent attributes are selected to save space
 def load_attr(fns, e, ent2id, topA=1000):
-    cnt = {}
+    """
+    binary (e, min(topA, #attr)) CSR matrix of the topA most frequent attributes of each entity
+    """
+    rows, attrs = [], []
     for fn in fns:
         with open(fn, 'r', encoding='utf-8') as f:
             for line in f:
                 th = line[:-1].split('\t')
                 if th[0] not in ent2id:
                     continue
-                for i in range(1, len(th)):
-                    if th[i] not in cnt:
-                        cnt[th[i]] = 1
-                    else:
-                        cnt[th[i]] += 1
-    fre = [(k, cnt[k]) for k in sorted(cnt, key=cnt.get, reverse=True)]
-    attr2id = {}
-    # pdb.set_trace()
-    topA = min(1000, len(fre))
-    for i in range(topA):
-        attr2id[fre[i][0]] = i
-    attr = np.zeros((e, topA), dtype=np.float32)
-    for fn in fns:
-        with open(fn, 'r', encoding='utf-8') as f:
-            for line in f:
-                th = line[:-1].split('\t')
-                if th[0] in ent2id:
-                    for i in range(1, len(th)):
-                        if th[i] in attr2id:
-                            attr[ent2id[th[0]]][attr2id[th[i]]] = 1.0
+                rows.extend([ent2id[th[0]]] * (len(th) - 1))
+                attrs.extend(th[1:])
+    if len(attrs) == 0:
+        return sp.csr_matrix((e, 0), dtype=np.float32)
+    cols, topA = most_frequent(np.array(attrs), topA)
+    rows = np.array(rows, dtype=np.int64)
+    keep = cols >= 0
+    attr = sp.csr_matrix((np.ones(int(keep.sum()), dtype=np.float32), (rows[keep], cols[keep])), shape=(e, topA))
+    attr.sum_duplicates()
+    attr.data[:] = 1.0
     return attr
 
 
 def load_relation(e, KG, topR=1000):
-    # (39654, 1000)
-    rel_mat = np.zeros((e, topR), dtype=np.float32)
-    rels = np.array(KG)[:, 1]
-    top_rels = Counter(rels).most_common(topR)
-    rel_index_dict = {r: i for i, (r, cnt) in enumerate(top_rels)}
-    for tri in KG:
-        h = tri[0]
-        r = tri[1]
-        o = tri[2]
-        if r in rel_index_dict:
-            rel_mat[h][rel_index_dict[r]] += 1.
-            rel_mat[o][rel_index_dict[r]] += 1.
-    return np.array(rel_mat)
+    """
+    (e, topR) CSR matrix counting, for each entity, the triples of the topR most frequent relations it is head or tail of
+    """
+    KG = np.asarray(KG, dtype=np.int64).reshape(-1, 3)
+    cols, _ = most_frequent(KG[:, 1], topR)
+    keep = cols >= 0
+    rows = np.concatenate([KG[keep, 0], KG[keep, 2]])
+    cols = np.concatenate([cols[keep], cols[keep]])
+    rel_mat = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(e, topR))
+    rel_mat.sum_duplicates()
+    return rel_mat
 
 
 def load_json_embd(path):
@@ -429,23 +641,34 @@ def load_json_embd(path):
     return embd_dict
 
 
-def load_img(logger, e_num, path):
+def read_img(e_num, path):
+    """
+    image features of the entities in the pickled dict (zeros for the others),
+    their mask, and the mean/std of all the known vectors used to fill the missing ones
+    """
     img_dict = pickle.load(open(path, "rb"))
-    # init unknown img vector with mean and std deviation of the known's
     imgs_np = np.array(list(img_dict.values()))
     mean = np.mean(imgs_np, axis=0)
     std = np.std(imgs_np, axis=0)
-    # img_embd = np.array([np.zeros_like(img_dict[0]) for i in range(e_num)]) # no image
-    # img_embd = np.array([img_dict[i] if i in img_dict else np.zeros_like(img_dict[0]) for i in range(e_num)])
-
+    img_ids = np.array(list(img_dict.keys()), dtype=np.int64)
+    known = (img_ids >= 0) & (img_ids < e_num)
+    img_embd = np.zeros((e_num, imgs_np.shape[1]), dtype=np.float32)
+    img_embd[img_ids[known]] = imgs_np[known]
     img_mask = np.zeros((e_num,), dtype=np.float32)
-    img_embd = []
-    for i in range(e_num):
-        if i in img_dict:
-            img_embd.append(img_dict[i])
-            img_mask[i] = 1.0
-        else:
-            img_embd.append(np.random.normal(mean, std, mean.shape[0]))
-    img_embd = np.array(img_embd)
-    logger.info(f"{(100 * len(img_dict) / e_num):.2f}% entities have images")
+    img_mask[img_ids[known]] = 1.0
+    return img_embd, img_mask, mean, std, len(img_dict)
+
+
+def impute_img(logger, img_embd, img_mask, mean, std, img_num, seed=None):
+    # init unknown img vector with mean and std deviation of the known's,
+    # in one draw from a generator seeded independently of the global numpy RNG
+    img_mask = np.array(img_mask, dtype=np.float32)
+    missing = np.flatnonzero(img_mask == 0)
+    e_num = img_embd.shape[0]
+    # the only in-memory copy of the (memory-mapped) compiled matrix
+    img_embd = np.array(img_embd, dtype=np.float32)
+    if len(missing):
+        rng = np.random.default_rng(seed)
+        img_embd[missing] = rng.normal(mean, std, (len(missing), mean.shape[0])).astype(np.float32)
+    logger.info(f"{(100 * img_num / e_num):.2f}% entities have images")
     return img_embd, img_mask
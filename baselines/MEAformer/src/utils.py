@@ -16,7 +16,9 @@ import re
 import pdb
 from torch import nn
 from numpy import mean
+import atexit
 import multiprocessing
+from multiprocessing import shared_memory
 import math
 import random
 import numpy as np
@@ -24,6 +26,22 @@ import scipy
 import scipy.sparse as sp
 
 
+def setup_device(args):
+    """
+    Resolve --device ('cuda' means the --gpu device) and apply the backend settings:
+    number of CPU threads and float32 matmul precision.
+    """
+    device = torch.device(args.device)
+    if device.type == "cuda":
+        if device.index is None:
+            device = torch.device("cuda", args.gpu)
+        torch.cuda.set_device(device)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.set_float32_matmul_precision(args.matmul_precision)
+    return device
+
+
 def set_optim(opt, model_list, freeze_part=[], accumulation_step=None):
     named_parameters = []
     param_name = []
@@ -234,7 +252,7 @@ def sparse_mx_to_torch_sparse_tensor(sparse_mx):
         np.vstack((sparse_mx.row, sparse_mx.col)).astype(np.int64))
     values = torch.FloatTensor(sparse_mx.data)
     shape = torch.Size(sparse_mx.shape)
-    return torch.sparse.FloatTensor(indices, values, shape)
+    return torch.sparse_coo_tensor(indices, values, shape)
 
 
 def div_list(ls, n):
@@ -322,8 +340,53 @@ def nearest_neighbor_sampling(emb, left, right, K):
     return neg_left, neg_right
 
 
+def build_graph_structure(ent_size, triples):
+    """
+    Vectorized get_adjr(norm=True): the symmetric adjacency counting the triples
+    between two entities, with self loops, normalized as D^-1/2 A D^-1/2.
+    Returns numpy arrays: the coalesced edge list edge_index (2, nnz) in row-major order
+    and its values data (nnz,).
+    """
+    triples = np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+    head, tail = triples[:, 0], triples[:, 2]
+    keep = head != tail
+    pair, count = np.unique(head[keep] * ent_size + tail[keep], return_counts=True)
+    fir, sec = pair // ent_size, pair % ent_size
+    loop = np.arange(ent_size, dtype=np.int64)
+    row = np.concatenate([fir, sec, loop])
+    col = np.concatenate([sec, fir, loop])
+    val = np.concatenate([count, count, np.ones(ent_size, dtype=np.int64)]).astype(np.float32)
+    adj = sp.coo_matrix((val, (row, col)), shape=(ent_size, ent_size), dtype=np.float32).tocsr()
+    adj.sum_duplicates()
+    adj.sort_indices()
+
+    degree = np.asarray(adj.sum(1), dtype=np.float32).flatten()
+    r_inv_sqrt = np.power(degree, -0.5)
+    r_inv_sqrt[np.isinf(r_inv_sqrt)] = 0.
+    row = np.repeat(np.arange(ent_size, dtype=np.int64), np.diff(adj.indptr))
+    col = adj.indices.astype(np.int64)
+    data = (adj.data * r_inv_sqrt[row] * r_inv_sqrt[col]).astype(np.float32)
+    return {
+        "edge_index": np.stack([row, col]),
+        "data": data,
+    }
+
+
+def graph_to_sparse_tensor(graph, ent_size):
+    """
+    Coalesced torch sparse adjacency from the arrays of build_graph_structure,
+    sharing their memory (e.g. a memory-mapped cache entry) instead of copying it.
+    """
+    indices = torch.from_numpy(np.asarray(graph["edge_index"], dtype=np.int64))
+    values = torch.from_numpy(np.asarray(graph["data"], dtype=np.float32))
+    return torch.sparse_coo_tensor(indices, values, torch.Size([ent_size, ent_size]),
+                                   is_coalesced=True, check_invariants=False)
+
+
 def get_adjr(ent_size, triples, norm=False):
     print('getting a sparse tensor r_adj...')
+    if norm:
+        return graph_to_sparse_tensor(build_graph_structure(ent_size, triples), ent_size)
     M = {}
     for tri in triples:
         if tri[0] == tri[2]:
@@ -355,6 +418,34 @@ def get_adjr(ent_size, triples, norm=False):
         return M
 
 
+def k_hop_subgraph(nodes, adj, num_hops):
+    """
+    Receptive field of a num_hops-layer graph encoder on `nodes`.
+    Parameters
+    ----------
+    nodes : LongTensor of entity ids.
+    adj : sparse (ent_num, ent_num) adjacency, row i aggregates its columns.
+    Returns
+    -------
+    subset : sorted ids of the entities within num_hops of nodes.
+    sub_adj : adj restricted to subset, relabelled to 0..len(subset)-1.
+    mapping : position of every entry of nodes in subset.
+    """
+    edge = adj._indices()
+    num_nodes = adj.shape[0]
+    mask = torch.zeros(num_nodes, dtype=torch.bool, device=edge.device)
+    mask[nodes] = True
+    for _ in range(num_hops):
+        mask[edge[1, mask[edge[0]]]] = True
+    subset = mask.nonzero(as_tuple=False).squeeze(1)
+    relabel = torch.full((num_nodes,), -1, dtype=torch.int64, device=edge.device)
+    relabel[subset] = torch.arange(subset.shape[0], device=edge.device)
+    edge_mask = mask[edge[0]] & mask[edge[1]]
+    sub_adj = torch.sparse_coo_tensor(relabel[edge[:, edge_mask]], adj._values()[edge_mask],
+                                      torch.Size([subset.shape[0], subset.shape[0]]))
+    return subset, sub_adj, relabel[nodes]
+
+
 def multi_cal_rank(task, sim, top_k, l_or_r):
     mean = 0
     mrr = 0
@@ -375,11 +466,107 @@ def multi_cal_rank(task, sim, top_k, l_or_r):
     return mean, num, mrr
 
 
-def multi_get_hits(Lvec, Rvec, top_k=(1, 5, 10, 50, 100), args=None):
-    result = []
-    sim = pairwise_distances(torch.FloatTensor(Lvec), torch.FloatTensor(Rvec)).numpy()
-    if args.csls is True:
+def _slice_gold_rank(sim, start, end, l_or_r):
+    # 0-based gold ranks of the queries start..end, gold pairs on the diagonal of sim
+    pos = np.arange(end - start)
+    if l_or_r == 0:
+        block = sim[start:end, :]
+        gold = block[pos, np.arange(start, end)]
+        return (block < gold[:, None]).sum(1)
+    block = sim[:, start:end]
+    gold = block[np.arange(start, end), pos]
+    return (block < gold[None, :]).sum(0)
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 has no track argument
+        return shared_memory.SharedMemory(name=name)
+
+
+def shm_cal_rank(shm_name, shape, dtype, start, end, l_or_r):
+    shm = _attach_shared_memory(shm_name)
+    try:
+        sim = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        rank = _slice_gold_rank(sim, start, end, l_or_r)
+        del sim
+    finally:
+        shm.close()
+    return rank
+
+
+_rank_pool = None
+_rank_pool_size = 0
+
+
+def close_rank_pool():
+    global _rank_pool, _rank_pool_size
+    if _rank_pool is not None:
+        _rank_pool.close()
+        _rank_pool.join()
+    _rank_pool, _rank_pool_size = None, 0
+
+
+def get_rank_pool(processes=10):
+    """
+    Worker pool of the 'shm' backend of multi_get_hits, reused by later calls with the same
+    number of processes (rebuilt otherwise) and closed at exit.
+    """
+    global _rank_pool, _rank_pool_size
+    if _rank_pool is not None and _rank_pool_size != processes:
+        close_rank_pool()
+    if _rank_pool is None:
+        _rank_pool = multiprocessing.Pool(processes=processes)
+        _rank_pool_size = processes
+    return _rank_pool
+
+
+atexit.register(close_rank_pool)
+
+
+def multi_get_hits(Lvec, Rvec, top_k=(1, 5, 10, 50, 100), args=None, backend="vectorized", processes=10, block_size=4096):
+    """
+    Hits@k/MR/MRR of Lvec[i] <-> Rvec[i] in both directions.
+    backend:
+        'vectorized': one process, ranks counted block by block with torch (see gold_ranks);
+        'shm': persistent worker pool reading sim from shared memory, nothing is pickled but the task bounds;
+        'pool': a fresh multiprocessing.Pool per direction, each task pickling its slice of sim (legacy).
+    Returns [acc_l2r, mr_l2r, mrr_l2r, acc_r2l, mr_r2l, mrr_r2l].
+    """
+    assert backend in ["vectorized", "shm", "pool"]
+    sim = pairwise_distances(torch.FloatTensor(Lvec), torch.FloatTensor(Rvec))
+    if args is not None and args.csls is True:
         sim = 1 - csls_sim(1 - sim, args.csls_k)
+
+    if backend == "vectorized":
+        rank_l2r, rank_r2l = gold_ranks(sim, block_size)
+        return list(rank_metrics(rank_l2r, top_k) + rank_metrics(rank_r2l, top_k))
+
+    sim = sim.numpy()
+    if backend == "shm":
+        shm = shared_memory.SharedMemory(create=True, size=sim.nbytes)
+        try:
+            shared_sim = np.ndarray(sim.shape, dtype=sim.dtype, buffer=shm.buf)
+            shared_sim[:] = sim
+            del sim
+            pool = get_rank_pool(processes)
+            result = []
+            for i in [0, 1]:
+                s_len = shared_sim.shape[i]
+                bounds = np.linspace(0, s_len, processes + 1, dtype=np.int64)
+                reses = [pool.apply_async(shm_cal_rank, (shm.name, shared_sim.shape, shared_sim.dtype, int(bounds[j]), int(bounds[j + 1]), i))
+                         for j in range(processes) if bounds[j] < bounds[j + 1]]
+                rank = np.concatenate([res.get() for res in reses])
+                result.extend(rank_metrics(rank, top_k))
+            del shared_sim
+        finally:
+            shm.close()
+            shm.unlink()
+        return result
+
+    result = []
     for i in [0, 1]:
         top_total = np.array([0] * len(top_k))
         mean_total, mrr_total = 0.0, 0.0
@@ -431,6 +618,124 @@ def csls_sim(sim_mat, k):
     return csls_sim_mat
 
 
+def gold_ranks(distance, block_size=4096):
+    """
+    Rank of the gold candidate of every query, in both directions, from one pass.
+    Parameters
+    ----------
+    distance : tensor of n*n
+        distance[i, j] is the distance between the i-th left and the j-th right
+        test entity, so the gold pairs lie on the diagonal.
+    block_size : int
+        The number of rows compared at once.
+    Returns
+    -------
+    rank_l2r, rank_r2l : 0-based ranks, i.e. the number of candidates that are
+        strictly closer than the gold one.
+    """
+    n = distance.shape[0]
+    gold = torch.diagonal(distance)
+    rank_l2r = torch.empty(n, dtype=torch.int64, device=distance.device)
+    rank_r2l = torch.zeros(distance.shape[1], dtype=torch.int64, device=distance.device)
+    for start in range(0, n, block_size):
+        block = distance[start:start + block_size]
+        end = start + block.shape[0]
+        rank_l2r[start:end] = (block < gold[start:end].unsqueeze(1)).sum(1)
+        rank_r2l += (block < gold.unsqueeze(0)).sum(0)
+    return rank_l2r, rank_r2l
+
+
+def block_distances(x, y, distance=2):
+    """
+    Distance between a block of rows x and all the rows of y, L2 ('2', squared) or L1 ('1').
+    """
+    if distance == 1:
+        return torch.cdist(x, y, p=1)
+    return pairwise_distances(x, y)
+
+
+def csls_distance(dist, nearest_values1, nearest_values2):
+    """
+    1 - csls_sim written elementwise, so that a block of the matrix and its diagonal
+    are computed with exactly the same operations.
+    """
+    return 1 - (2 * (1 - dist) - nearest_values1 - nearest_values2)
+
+
+def tiled_gold_ranks(left_emb, right_emb, distance=2, csls_k=0, block_size=4096, pred_k=0):
+    """
+    Memory-bounded equivalent of gold_ranks on the (csls) distance matrix of
+    left_emb x right_emb, whose row i and column i are a gold pair.
+    The first pass (csls_neighbour_means) reads the gold distances from the
+    diagonal of every row block and, for CSLS, the mean similarity of the csls_k
+    nearest neighbours of every row and column; the second pass recomputes the
+    same blocks and counts the ranks, so gold and candidates come from the same
+    products. At most block_size rows of the matrix are alive at once.
+    Returns
+    -------
+    rank_l2r, rank_r2l : 0-based ranks, as in gold_ranks.
+    preds : (values, indices) of the pred_k nearest right entities of every left
+        entity, or None if pred_k is 0.
+    """
+    n, m = left_emb.shape[0], right_emb.shape[0]
+    device = left_emb.device
+    nearest_values1, nearest_values2, gold = csls_neighbour_means(left_emb, right_emb, distance, csls_k, block_size,
+                                                                  with_diagonal=True)
+    if csls_k > 0:
+        gold = csls_distance(gold, nearest_values1, nearest_values2[:n])
+
+    rank_l2r = torch.empty(n, dtype=torch.int64, device=device)
+    rank_r2l = torch.zeros(m, dtype=torch.int64, device=device)
+    if pred_k > 0:
+        pred_values = torch.empty((n, pred_k), dtype=left_emb.dtype, device=device)
+        pred_indices = torch.empty((n, pred_k), dtype=torch.int64, device=device)
+    for start in range(0, n, block_size):
+        block = block_distances(left_emb[start:start + block_size], right_emb, distance)
+        end = start + block.shape[0]
+        if csls_k > 0:
+            block = csls_distance(block, nearest_values1[start:end].unsqueeze(1), nearest_values2.unsqueeze(0))
+        rank_l2r[start:end] = (block < gold[start:end].unsqueeze(1)).sum(1)
+        rank_r2l += (block < gold.unsqueeze(0)).sum(0)
+        if pred_k > 0:
+            pred_values[start:end], pred_indices[start:end] = torch.topk(block, pred_k, dim=1, largest=False)
+        del block
+    preds = (pred_values, pred_indices) if pred_k > 0 else None
+    return rank_l2r, rank_r2l, preds
+
+
+def save_predictions(path, test_left, test_right, rank, values, indices, pred_format="csv"):
+    """
+    Write the top-k predictions of every test query in one shot.
+    path : file name without extension, "{path}.txt" (csv) and/or "{path}.npz" is written.
+    rank : 0-based gold ranks (l2r); values/indices : (n, k) top-k distances and positions in test_right.
+    """
+    test_left = test_left.cpu().numpy()
+    test_right = test_right.cpu().numpy()
+    rank = rank.cpu().numpy()
+    values = values.cpu().numpy()
+    indices = indices.cpu().numpy()
+    ret = test_right[indices]
+    k = ret.shape[1]
+    if pred_format in ["csv", "both"]:
+        header = ["idx", "rank", "query_id", "gt_id"] + [f"ret{i + 1}" for i in range(k)] + [f"v{i + 1}" for i in range(k)]
+        table = np.column_stack([np.arange(len(test_left)), rank, test_left, test_right, ret, values.astype(np.float64)])
+        np.savetxt(f"{path}.txt", table, fmt=["%d"] * (4 + k) + ["%.4f"] * k, delimiter=",",
+                   header=",".join(header), comments="", newline="\r\n")
+    if pred_format in ["npz", "both"]:
+        np.savez_compressed(f"{path}.npz", rank=rank, query_id=test_left, gt_id=test_right, ret=ret, value=values)
+
+
+def rank_metrics(rank, top_k=(1, 10, 50)):
+    """
+    Hits@k, MR and MRR from the 0-based ranks returned by gold_ranks.
+    """
+    if torch.is_tensor(rank):
+        rank = rank.cpu().numpy()
+    rank = rank.astype(np.float64) + 1
+    acc = np.array([round(np.mean(rank <= k), 4) for k in top_k], dtype=np.float32)
+    return acc, float(np.mean(rank)), float(np.mean(1.0 / rank))
+
+
 def get_topk_indices(M, K=1000):
     H, W = M.shape
     M_view = M.view(-1)
@@ -440,6 +745,129 @@ def get_topk_indices(M, K=1000):
     return two_d_indices
 
 
+def pair_keys(pairs, num):
+    """int64 key l * num + r of each (l, r) row of `pairs`, for hashed / np.isin set operations on links"""
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0] * num + pairs[:, 1]
+
+
+def _similarity_block(left, right_t, start, end):
+    # rows [start, end) of left @ right.T, for torch tensors or scipy sparse matrices
+    if sp.issparse(left):
+        return torch.from_numpy(np.asarray(left[start:end].dot(right_t).todense(), dtype=np.float32))
+    return left[start:end].mm(right_t)
+
+
+def blocked_topk_indices(left, right, K=1000, block_size=4096):
+    """
+    get_topk_indices(left @ right.T, K) without the full similarity matrix:
+    a running top-K over blocks of rows. Returns (values, (K, 2) indices), by decreasing similarity.
+    """
+    right_t = right.T.tocsc() if sp.issparse(right) else right.t()
+    W = right.shape[0]
+    vals = idx = None
+    for start in range(0, left.shape[0], block_size):
+        end = min(start + block_size, left.shape[0])
+        sim = _similarity_block(left, right_t, start, end).reshape(-1)
+        b_vals, b_idx = sim.topk(min(K, sim.numel()))
+        b_idx = b_idx + start * W
+        if vals is not None:
+            b_vals, b_idx = torch.cat([vals, b_vals]), torch.cat([idx, b_idx])
+            b_vals, order = b_vals.topk(min(K, b_vals.numel()))
+            b_idx = b_idx[order]
+        vals, idx = b_vals, b_idx
+    print("highest sim:", vals[0].item(), "lowest sim:", vals[-1].item())
+    return vals, torch.stack([idx // W, idx % W], dim=1)
+
+
+def _mutual_blocks(block_fn, n, block_size, largest):
+    # mutual best pairs of the n-row matrix given by block_fn(start, end), with a running
+    # row best/argbest and column best/argbest (ties: first index, as argmin/argmax)
+    row_val, row_arg = [], []
+    col_val = col_arg = None
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        block = block_fn(start, end)
+        v, a = block.max(dim=1) if largest else block.min(dim=1)
+        row_val.append(v)
+        row_arg.append(a)
+        c_val, c_arg = block.max(dim=0) if largest else block.min(dim=0)
+        c_arg = c_arg + start
+        del block
+        if col_val is None:
+            col_val, col_arg = c_val, c_arg
+        else:
+            better = c_val > col_val if largest else c_val < col_val
+            col_val = torch.where(better, c_val, col_val)
+            col_arg = torch.where(better, c_arg, col_arg)
+    row_val, row_arg = torch.cat(row_val), torch.cat(row_arg)
+    left_idx = torch.nonzero(col_arg[row_arg] == torch.arange(n, device=row_arg.device)).view(-1)
+    return left_idx, row_arg[left_idx], row_val[left_idx]
+
+
+def mutual_nn_pairs(left, right, block_size=4096):
+    """
+    Pairs (i, j) such that j is the most similar right row of left row i and i the most similar left row of j,
+    without the full similarity matrix (see _mutual_blocks).
+    Returns left indices, right indices and similarities, by decreasing similarity.
+    """
+    right_t = right.T.tocsc() if sp.issparse(right) else right.t()
+    left_idx, right_idx, score = _mutual_blocks(lambda start, end: _similarity_block(left, right_t, start, end),
+                                                left.shape[0], block_size, largest=True)
+    score, order = score.sort(descending=True)
+    return left_idx[order], right_idx[order], score
+
+
+def csls_neighbour_means(left_emb, right_emb, distance=2, csls_k=10, block_size=4096, with_diagonal=False):
+    """
+    Mean similarity (1 - distance) of the csls_k nearest neighbours of every left row
+    and of every right row, over blocks of rows ((None, None) if csls_k is 0).
+    with_diagonal : also return the distance of left row i to right row i, read from
+        the same blocks (the gold distances of tiled_gold_ranks).
+    """
+    n, m = left_emb.shape[0], right_emb.shape[0]
+    nearest_values1, nearest_values2, col_top = None, None, None
+    if csls_k > 0:
+        row_k, col_k = min(csls_k, m), min(csls_k, n)
+        nearest_values1 = torch.empty(n, dtype=left_emb.dtype, device=left_emb.device)
+    if with_diagonal:
+        diagonal = torch.empty(n, dtype=left_emb.dtype, device=left_emb.device)
+    for start in range(0, n, block_size):
+        block = block_distances(left_emb[start:start + block_size], right_emb, distance)
+        end = start + block.shape[0]
+        if with_diagonal:
+            diagonal[start:end] = torch.diagonal(block, offset=start)
+        if csls_k > 0:
+            sim = 1 - block
+            nearest_values1[start:end] = torch.mean(torch.topk(sim, row_k, dim=1)[0], 1)
+            col_top = sim if col_top is None else torch.cat([col_top, sim], dim=0)
+            col_top = torch.topk(col_top, min(col_k, col_top.shape[0]), dim=0)[0]
+            del sim
+        del block
+    if csls_k > 0:
+        nearest_values2 = torch.mean(col_top, 0)
+    if with_diagonal:
+        return nearest_values1, nearest_values2, diagonal
+    return nearest_values1, nearest_values2
+
+
+def mutual_nearest_neighbours(left_emb, right_emb, distance=2, csls_k=0, block_size=4096):
+    """
+    Streaming mutual nearest neighbours under the (csls, if csls_k > 0) distance of left_emb x right_emb:
+    only a block of block_size rows and the running row/column minima are alive at once.
+    Returns left indices (increasing), right indices and distances, as tensors on the device of the embeddings.
+    """
+    if csls_k > 0:
+        nearest_values1, nearest_values2 = csls_neighbour_means(left_emb, right_emb, distance, csls_k, block_size)
+
+    def block_fn(start, end):
+        block = block_distances(left_emb[start:end], right_emb, distance)
+        if csls_k > 0:
+            block = csls_distance(block, nearest_values1[start:end].unsqueeze(1), nearest_values2.unsqueeze(0))
+        return block
+    return _mutual_blocks(block_fn, left_emb.shape[0], block_size, largest=False)
+
+
 def normalize_zero_one(A):
     A -= A.min(1, keepdim=True)[0]
     A /= A.max(1, keepdim=True)[0]
@@ -80,7 +80,7 @@ class Top_K_Metric(Metric):
         if len(true.shape) == 3:
             true = true[0]
         _, ok = predicted.topk(max(self.topnum), dim=1)
-        agreeing_all = torch.zeros([predicted.shape[0], 1], dtype=torch.float).cuda()
+        agreeing_all = torch.zeros([predicted.shape[0], 1], dtype=torch.float, device=predicted.device)
         top_k_list = [0] * self.topnum
         for i in range(max(self.topnum)):
             tmp = ok[:, i].reshape(-1, 1)
@@ -0,0 +1,162 @@
+import argparse
+import copy
+import math
+import multiprocessing
+import resource
+import sys
+import time
+import types
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "baselines" / "MEAformer"))
+
+from model.MEAformer_tools import MformerFusion, BertSelfAttention  # noqa: E402
+
+
+class LegacySelfAttention(BertSelfAttention):
+    """Previous BertSelfAttention: three projections, explicit softmax and permute / contiguous copies."""
+    def transpose_for_scores(self, x):
+        x = x.view(x.size()[:-1] + (self.num_attention_heads, self.attention_head_size))
+        return x.permute(0, 2, 1, 3)
+
+    def forward(self, hidden_states, output_attentions=False):
+        query_layer = self.transpose_for_scores(self.query(hidden_states))
+        key_layer = self.transpose_for_scores(self.key(hidden_states))
+        value_layer = self.transpose_for_scores(self.value(hidden_states))
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2)) / math.sqrt(self.attention_head_size)
+        attention_probs = self.dropout(F.softmax(attention_scores, dim=-1))
+        context_layer = torch.matmul(attention_probs, value_layer).permute(0, 2, 1, 3).contiguous()
+        context_layer = context_layer.view(context_layer.size()[:-2] + (self.all_head_size,))
+        return (context_layer, attention_probs) if output_attentions else (context_layer,)
+
+
+def legacy_forward(self, embs):
+    """Previous MformerFusion.forward: attention probabilities requested from every layer."""
+    embs = [emb for emb in embs if emb is not None]
+    modal_num = len(embs)
+    hidden_states = torch.stack(embs, dim=1)
+    for layer_module in self.fusion_layer:
+        # every layer ran with output_attentions=True
+        self_outputs = layer_module.attention.self(hidden_states, output_attentions=True)
+        attention_output = layer_module.attention.output(self_outputs[0], hidden_states)
+        if layer_module.config.use_intermediate:
+            hidden_states = layer_module.feed_forward_chunk(attention_output)
+        else:
+            hidden_states = attention_output
+        attention_probs = self_outputs[1]
+    attention_pro = torch.sum(attention_probs, dim=-3)
+    attention_pro_comb = torch.sum(attention_pro, dim=-2) / math.sqrt(modal_num * self.args.num_attention_heads)
+    weight_norm = F.softmax(attention_pro_comb, dim=-1)
+    embs = [weight_norm[:, idx].unsqueeze(1) * F.normalize(embs[idx]) for idx in range(modal_num)]
+    return torch.cat(embs, dim=1), hidden_states, weight_norm
+
+
+def make_fusion(args, device):
+    fusion = MformerFusion(args, modal_num=args.modal_num).to(device)
+    legacy = copy.deepcopy(fusion)
+    for layer_module in legacy.fusion_layer:
+        layer_module.attention.self.__class__ = LegacySelfAttention
+    legacy.forward = types.MethodType(legacy_forward, legacy)
+    return fusion, legacy
+
+
+def check_outputs(args, device):
+    fusion, legacy = make_fusion(args, device)
+    fusion.eval()
+    legacy.eval()
+    ok = True
+    # below and above sdpa_min_rows: explicit softmax and scaled_dot_product_attention
+    for num_ent in (257, BertSelfAttention.sdpa_min_rows + 1):
+        embs = [torch.randn(num_ent, args.hidden_size, device=device) for _ in range(args.modal_num)]
+        with torch.no_grad():
+            new = fusion(embs)
+            old = legacy(embs)
+        same = all(torch.allclose(x, y, atol=1e-5) for x, y in zip(new, old))
+        diff = max((x - y).abs().max().item() for x, y in zip(new, old))
+        print(f"{num_ent} entities, outputs match: {same} (max abs diff {diff:.2e})")
+        ok = ok and same
+    return ok
+
+
+def attention_path(num_ent, train, device):
+    """Kernel BertSelfAttention uses in the layers that do not return the probabilities."""
+    if num_ent < BertSelfAttention.sdpa_min_rows or (train and device.type == "cpu"):
+        return "softmax"
+    return "sdpa"
+
+
+def run_once(module, embs, train):
+    module.train(train)
+    if embs[0].is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    t0 = time.perf_counter()
+    if train:
+        joint_emb, hidden_states, _ = module(embs)
+        (joint_emb.sum() + hidden_states.sum()).backward()
+        module.zero_grad(set_to_none=True)
+    else:
+        with torch.no_grad():
+            module(embs)
+    if embs[0].is_cuda:
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - t0
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if embs[0].is_cuda else float("nan")
+    return elapsed, peak
+
+
+def _cpu_peak_child(module, embs, train, queue):
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run_once(module, embs, train)
+    queue.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 1024)
+
+
+def cpu_peak(module, embs, train):
+    """Growth of the peak RSS (MiB) of one run, measured in a forked child so that every run starts from the same peak."""
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_cpu_peak_child, args=(module, embs, train, queue))
+    proc.start()
+    peak = queue.get()
+    proc.join()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark MformerFusion against the previous attention implementation.")
+    parser.add_argument("--sizes", default="2000,10000,40000", help="numbers of entities")
+    parser.add_argument("--modal_num", type=int, default=6)
+    parser.add_argument("--hidden_size", type=int, default=300)
+    parser.add_argument("--num_attention_heads", type=int, default=1)
+    parser.add_argument("--num_hidden_layers", type=int, default=2)
+    parser.add_argument("--intermediate_size", type=int, default=400)
+    parser.add_argument("--use_intermediate", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    if not check_outputs(args, device):
+        raise SystemExit(1)
+
+    fusion, legacy = make_fusion(args, device)
+    print(f"{'n':>7} {'mode':>6} {'fusion':>7} {'path':>8} {'best_s':>9} {'peak_MiB':>10}")
+    for num_ent in [int(x) for x in args.sizes.split(",") if x]:
+        embs = [torch.randn(num_ent, args.hidden_size, device=device) for _ in range(args.modal_num)]
+        for train in (False, True):
+            for name, module in [("new", fusion), ("legacy", legacy)]:
+                run_once(module, embs, train)  # warm-up
+                runs = [run_once(module, embs, train) for _ in range(args.repeat)]
+                # CUDA: max_memory_allocated of the runs; CPU: peak RSS growth of a separate run
+                peak = max(r[1] for r in runs) if device.type == "cuda" else cpu_peak(module, embs, train)
+                mode = "train" if train else "eval"
+                path = attention_path(num_ent, train, device) if name == "new" else "softmax"
+                print(f"{num_ent:>7} {mode:>6} {name:>7} {path:>8} {min(r[0] for r in runs):>9.4f} {peak:>10.1f}")
+        del embs
+
+
+if __name__ == "__main__":
+    main()
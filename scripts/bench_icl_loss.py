@@ -0,0 +1,100 @@
+import argparse
+import functools
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "baselines" / "MEAformer"))
+
+from model.MEAformer_loss import icl_loss, multi_view_icl_loss  # noqa: E402
+
+
+def make_views(num_ent, dims, device, dtype, seed):
+    gen = torch.Generator().manual_seed(seed)
+    return [torch.randn(num_ent, d, generator=gen, dtype=dtype).to(device).requires_grad_(True) for d in dims]
+
+
+def make_links(num_ent, batch_size, device, seed):
+    gen = torch.Generator().manual_seed(seed + 1)
+    ids = torch.randperm(num_ent, generator=gen)[:2 * batch_size]
+    return ids.view(2, batch_size).t().contiguous().to(device)
+
+
+def per_view(views, links, tau, ab_weight):
+    criterion = icl_loss(tau=tau, ab_weight=ab_weight, n_view=2)
+    return torch.stack([criterion(emb, links) for emb in views])
+
+
+def fused(views, links, tau, ab_weight, block_size=0):
+    return multi_view_icl_loss(tau=tau, ab_weight=ab_weight, block_size=block_size)(views, links)
+
+
+def check_equivalence(device, dims):
+    views = make_views(500, dims, device, torch.float64, seed=0)
+    links = make_links(500, 64, device, seed=0)
+    weights = torch.rand(len(dims), dtype=torch.float64, device=device)
+    loss_old = per_view(views, links, 0.1, 0.5)
+    grad_old = torch.autograd.grad((weights * loss_old).sum(), views)
+    ok = True
+    for name, block_size in [("fused", 0), ("chunked", 24)]:
+        loss_new = fused(views, links, 0.1, 0.5, block_size)
+        grad_new = torch.autograd.grad((weights * loss_new).sum(), views)
+        same_loss = torch.allclose(loss_old, loss_new)
+        same_grad = all(torch.allclose(x, y) for x, y in zip(grad_old, grad_new))
+        print(f"{name}: losses match: {same_loss}, gradients match: {same_grad}")
+        ok = ok and same_loss and same_grad
+    return ok
+
+
+def run_once(fn, views, links, tau, ab_weight):
+    if links.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    t0 = time.perf_counter()
+    fn(views, links, tau, ab_weight).sum().backward()
+    for emb in views:
+        emb.grad = None
+    if links.is_cuda:
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - t0
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if links.is_cuda else float("nan")
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark the fused (dense or chunked) multi-view icl_loss against one icl_loss call per modality.")
+    parser.add_argument("--batch_sizes", default="512,2048,4500,16384")
+    parser.add_argument("--num_ent", type=int, default=30000)
+    parser.add_argument("--dims", default="300,300,300,300,300,300", help="width of every modality")
+    parser.add_argument("--tau", type=float, default=0.1)
+    parser.add_argument("--ab_weight", type=float, default=0.5)
+    parser.add_argument("--block_size", type=int, default=1024, help="row block of the chunked loss")
+    parser.add_argument("--skip_dense_above", type=int, default=8192, help="do not run the dense losses on larger batches")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    dims = [int(x) for x in args.dims.split(",") if x]
+
+    if not check_equivalence(device, dims):
+        raise SystemExit(1)
+
+    views = make_views(args.num_ent, dims, device, torch.float32, seed=1)
+    print(f"{'batch':>7} {'loss':>9} {'best_s':>9} {'peak_MiB':>10}")
+    for batch_size in [int(x) for x in args.batch_sizes.split(",") if x]:
+        links = make_links(args.num_ent, batch_size, device, seed=batch_size)
+        chunked = functools.partial(fused, block_size=args.block_size)
+        for name, fn in [("chunked", chunked), ("fused", fused), ("per_view", per_view)]:
+            if name != "chunked" and batch_size > args.skip_dense_above:
+                logits_mib = len(dims) * 4 * batch_size ** 2 * 4 / 2 ** 20
+                print(f"{batch_size:>7} {name:>9} {'skipped':>9} {logits_mib:>10.0f} (logits alone)")
+                continue
+            run_once(fn, views, links, args.tau, args.ab_weight)  # warm-up
+            runs = [run_once(fn, views, links, args.tau, args.ab_weight) for _ in range(args.repeat)]
+            print(f"{batch_size:>7} {name:>9} {min(r[0] for r in runs):>9.4f} {max(r[1] for r in runs):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
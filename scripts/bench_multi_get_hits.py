@@ -0,0 +1,54 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "baselines" / "MEAformer"))
+
+from src.utils import multi_get_hits  # noqa: E402
+
+
+def make_embeddings(n, dim, noise, seed):
+    rng = np.random.default_rng(seed)
+    left = rng.standard_normal((n, dim)).astype(np.float32)
+    right = left + noise * rng.standard_normal((n, dim)).astype(np.float32)
+    left /= np.linalg.norm(left, axis=1, keepdims=True)
+    right /= np.linalg.norm(right, axis=1, keepdims=True)
+    return left, right
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backends of MEAformer multi_get_hits.")
+    parser.add_argument("--sizes", default="1000,5000,10000")
+    parser.add_argument("--dim", type=int, default=300)
+    parser.add_argument("--noise", type=float, default=5.0,
+                        help="scale of the perturbation of the right embeddings; at 300 dims hits@1 is about 0.6 (1k) to 0.35 (10k)")
+    parser.add_argument("--backends", default="vectorized,shm,pool")
+    parser.add_argument("--processes", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    backends = [b for b in args.backends.split(",") if b]
+    print(f"{'n':>7} {'backend':>11} {'best_s':>9} {'mean_s':>9}  l2r hits@1/mrr  r2l hits@1/mrr")
+    for n in [int(x) for x in args.sizes.split(",") if x]:
+        left, right = make_embeddings(n, args.dim, args.noise, args.seed)
+        reference = None
+        for backend in backends:
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                res = multi_get_hits(left, right, top_k=(1, 10, 50), backend=backend, processes=args.processes)
+                times.append(time.perf_counter() - t0)
+            if reference is None:
+                reference = res
+            elif not all(np.allclose(x, y) for x, y in zip(res, reference)):
+                print(f"[WARN] {backend} metrics differ from {backends[0]}: {res} vs {reference}")
+            print(f"{n:>7} {backend:>11} {min(times):>9.3f} {np.mean(times):>9.3f}  "
+                  f"{res[0][0]:.4f}/{res[2]:.4f}  {res[3][0]:.4f}/{res[5]:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "baselines" / "MEAformer"))
+
+from model.layers import SpecialSpmmFunction  # noqa: E402
+
+
+class DenseGradSpmmFunction(torch.autograd.Function):
+    """Previous SpecialSpmmFunction: the gradient of the values goes through a dense N x N matrix."""
+    @staticmethod
+    def forward(ctx, indices, values, shape, b):
+        a = torch.sparse_coo_tensor(indices, values, shape)
+        ctx.save_for_backward(a, b)
+        ctx.N = shape[0]
+        return torch.matmul(a, b)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        a, b = ctx.saved_tensors
+        grad_values = grad_b = None
+        if ctx.needs_input_grad[1]:
+            grad_a_dense = grad_output.matmul(b.t())
+            edge_idx = a._indices()[0, :] * ctx.N + a._indices()[1, :]
+            grad_values = grad_a_dense.view(-1)[edge_idx]
+        if ctx.needs_input_grad[3]:
+            grad_b = a.t().matmul(grad_output)
+        return None, grad_values, None, grad_b
+
+
+def random_graph(n, avg_degree, device, dtype, seed):
+    gen = torch.Generator().manual_seed(seed)
+    num_edge = n * avg_degree
+    indices = torch.randint(0, n, (2, num_edge), generator=gen)
+    indices = torch.cat([indices, torch.arange(n).repeat(2, 1)], dim=1)
+    indices = torch.sparse_coo_tensor(indices, torch.ones(indices.shape[1]), (n, n)).coalesce().indices()
+    values = torch.rand(indices.shape[1], generator=gen, dtype=dtype)
+    return indices.to(device), values.to(device)
+
+
+def check_gradients(device):
+    indices, values = random_graph(60, 4, device, torch.float64, seed=0)
+    b = torch.randn(60, 8, dtype=torch.float64, device=device)
+    values.requires_grad_(True)
+    b.requires_grad_(True)
+    shape = torch.Size([60, 60])
+    SpecialSpmmFunction.edge_chunk, chunk = 17, SpecialSpmmFunction.edge_chunk
+    try:
+        ok = torch.autograd.gradcheck(lambda v, x: SpecialSpmmFunction.apply(indices, v, shape, x), (values, b))
+    finally:
+        SpecialSpmmFunction.edge_chunk = chunk
+    out_new = SpecialSpmmFunction.apply(indices, values, shape, b)
+    grad_new = torch.autograd.grad(out_new.pow(2).sum(), (values, b))
+    out_old = DenseGradSpmmFunction.apply(indices, values, shape, b)
+    grad_old = torch.autograd.grad(out_old.pow(2).sum(), (values, b))
+    same = all(torch.allclose(x, y) for x, y in zip(grad_new, grad_old))
+    print(f"gradcheck: {ok}, matches dense backward: {same}")
+    return ok and same
+
+
+def run_once(fn, indices, values, b, n):
+    values = values.detach().requires_grad_(True)
+    b = b.detach().requires_grad_(True)
+    if values.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    t0 = time.perf_counter()
+    out = fn.apply(indices, values, torch.Size([n, n]), b)
+    out.sum().backward()
+    if values.is_cuda:
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - t0
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if values.is_cuda else float("nan")
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gradcheck and benchmark the SDDMM backward of SpecialSpmmFunction.")
+    parser.add_argument("--sizes", default="5000,20000,40000")
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--avg_degree", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--skip_dense_above", type=int, default=40000, help="do not run the dense backward on larger graphs")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    if not check_gradients(device):
+        raise SystemExit(1)
+
+    print(f"{'n':>7} {'edges':>9} {'backward':>9} {'best_s':>9} {'peak_MiB':>10}")
+    for n in [int(x) for x in args.sizes.split(",") if x]:
+        indices, values = random_graph(n, args.avg_degree, device, torch.float32, seed=n)
+        b = torch.randn(n, args.dim, device=device)
+        for name, fn in [("sddmm", SpecialSpmmFunction), ("dense", DenseGradSpmmFunction)]:
+            if name == "dense" and n > args.skip_dense_above:
+                print(f"{n:>7} {indices.shape[1]:>9} {name:>9} {'skipped':>9} {n * n * 4 / 2 ** 20:>10.0f} (dense grad alone)")
+                continue
+            runs = [run_once(fn, indices, values, b, n) for _ in range(args.repeat)]
+            print(f"{n:>7} {indices.shape[1]:>9} {name:>9} {min(r[0] for r in runs):>9.4f} {max(r[1] for r in runs):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
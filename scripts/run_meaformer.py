@@ -173,6 +173,40 @@ def main():
         cmd.extend(["--use_missing_gate", str(m["use_missing_gate"])])
     if "missing_align_weight" in m:
         cmd.extend(["--missing_align_weight", str(m["missing_align_weight"])])
+    if "eval_block_size" in m:
+        cmd.extend(["--eval_block_size", str(m["eval_block_size"])])
+    if "pred_topk" in m:
+        cmd.extend(["--pred_topk", str(m["pred_topk"])])
+    if "pred_format" in m:
+        cmd.extend(["--pred_format", str(m["pred_format"])])
+    if "subgraph_train" in m:
+        cmd.extend(["--subgraph_train", str(m["subgraph_train"])])
+    if "data_cache" in m:
+        cmd.extend(["--data_cache", str(m["data_cache"])])
+    if "cache_dir" in m:
+        cmd.extend(["--cache_dir", str(m["cache_dir"])])
+    if "rel_topk" in m:
+        cmd.extend(["--rel_topk", str(m["rel_topk"])])
+    if "attr_topk" in m:
+        cmd.extend(["--attr_topk", str(m["attr_topk"])])
+    if "il_csls" in m:
+        cmd.extend(["--il_csls", str(m["il_csls"])])
+    if "il_async" in m:
+        cmd.extend(["--il_async", str(m["il_async"])])
+    if "emb_cache" in m:
+        cmd.extend(["--emb_cache", str(m["emb_cache"])])
+    if "emb_cache_fp16" in m:
+        cmd.extend(["--emb_cache_fp16", str(m["emb_cache_fp16"])])
+    if "emb_cache_offload" in m:
+        cmd.extend(["--emb_cache_offload", str(m["emb_cache_offload"])])
+    if "log_steps" in m:
+        cmd.extend(["--log_steps", str(m["log_steps"])])
+    if "cl_block_size" in m:
+        cmd.extend(["--cl_block_size", str(m["cl_block_size"])])
+    if "queue_size" in m:
+        cmd.extend(["--queue_size", str(m["queue_size"])])
+    if "queue_max_age" in m:
+        cmd.extend(["--queue_max_age", str(m["queue_max_age"])])
     if m.get("csls", True):
         cmd.append("--csls")
     if m.get("enable_sota", True):